@@ -1,13 +1,27 @@
-from flask import Blueprint, render_template, session, redirect, url_for, request, jsonify
+from flask import Blueprint, Response, render_template, session, redirect, url_for, request, jsonify
+import admission
+import content_index
 import db_connection
+import genre_identify
+import jobs
+import metrics
+import profiling
+import reference_data
 admin_blueprint = Blueprint('admin_actions', __name__)
-connection = db_connection.get_db_conn()
+admin_blueprint.teardown_app_request(db_connection.close_db_conn)  # Return the pooled connection
+# Request ids, request latency and the optional per-request log for the whole app
+admin_blueprint.before_app_request(metrics.start_request)
+admin_blueprint.after_app_request(metrics.finish_request)
+# Opt-in profiling of preset saves and the re-render jobs they queue, see profiling.py
+admin_blueprint.before_request(profiling.start_request)
+admin_blueprint.after_request(profiling.finish_request)
+admin_blueprint.teardown_request(profiling.teardown_request)
 
 
 @admin_blueprint.route('/admin_dashboard')
 def admin_dashboard():
     if session.get('username') == 'admin':
-        connection.reconnect()
+        connection = db_connection.get_db_conn()
         cursor = connection.cursor(dictionary=True)
 
         # Total uploads (total rows in renderings)
@@ -39,7 +53,7 @@ def admin_dashboard():
 @admin_blueprint.route('/admin/users_list')
 def users_list():
     if session.get('username') == 'admin':
-        connection.reconnect()
+        connection = db_connection.get_db_conn()
         cursor = connection.cursor(dictionary=True)
         cursor.execute("""select * from users where username != 'admin'""")
         users = cursor.fetchall()
@@ -51,7 +65,7 @@ def users_list():
 @admin_blueprint.route('/admin/eq_presets')
 def eq_presets():
     if session.get('username') == 'admin':
-        connection.reconnect()
+        connection = db_connection.get_db_conn()
         cursor = connection.cursor(dictionary=True)
         cursor.execute('''SELECT  genres.genre, eq_levels.sub_bass, eq_levels.bass, eq_levels.lower_midrange, eq_levels.midrange, 
         eq_levels.upper_midrange, eq_levels.low_treble, eq_levels.treble, eq_levels.presence, eq_levels.brilliance, 
@@ -85,7 +99,7 @@ def save_eq_presets():
         if not genre:
             return jsonify({'error': 'Missing genre_id'}), 400
 
-        connection.reconnect()
+        connection = db_connection.get_db_conn()
         cursor = connection.cursor()
         cursor.execute('''select genre_id from genres where genre = %s''', (genre,))
         genre_id = cursor.fetchone()[0]
@@ -96,10 +110,83 @@ def save_eq_presets():
         cursor.execute(update_query, (sub_bass, bass, lower_midrange, midrange, upper_midrange,
                                       low_treble, treble, presence, brilliance, air, genre_id))
         connection.commit()
+        reference_data.invalidate()  # Every worker reloads the presets on its next lookup
+
+        # Renders made with the old values are brought up to date in the background. A queued re-render of
+        # this genre reads the new version when it starts and a running one reads it for every batch, so
+        # one is enough.
+        pending = any(job['status'] in (jobs.QUEUED, jobs.RUNNING) and job['params']['genre_id'] == genre_id
+                      for job in jobs.recent_jobs('rerender', limit=50))
+        if not pending:
+            try:
+                jobs.enqueue('rerender', {'genre_id': genre_id})  # Not counted against the admin's user quota
+            except jobs.JobQueueFull as e:
+                print(f"Re-render of genre {genre_id} not queued: {e}")
         return jsonify({'message': 'EQ Preset updated successfully'}), 200
     else:
         return jsonify({'error': 'Unauthorized'}), 403
 
+# Stale renders per genre and the progress of recent re-render jobs, polled by the dashboard
+@admin_blueprint.route('/admin/rerender_status')
+def rerender_status():
+    if session.get('username') != 'admin':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    genres = {item['genre_id']: item['genre'] for item in reference_data.get_genres()}
+    stale = {genre: content_index.count_stale(genre_id, reference_data.get_preset_version(genre_id))
+             for genre_id, genre in genres.items()}
+    recent = [{'genre': genres.get(job['params']['genre_id'], job['params']['genre_id']), 'status': job['status'],
+               'progress': job['progress'], 'result': job['result'], 'error': job['error']}
+              for job in jobs.recent_jobs('rerender')]
+    return jsonify({'stale': stale, 'jobs': recent}), 200
+
+
+# Queue depths, wait times and rejections of the heavy endpoints, for sizing worker counts
+@admin_blueprint.route('/admin/load_stats')
+def load_stats():
+    if session.get('username') == 'admin':
+        return jsonify({'admission': admission.stats(), 'jobs': jobs.queue_stats(),
+                        'genre_inference': genre_identify.inference_stats(), 'stages': metrics.summary()})
+    else:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+
+# Queue depths and pool counters read at scrape time, in the form metrics.exposition takes. Cache hits and
+# misses are recorded with metrics.count where they happen, so those of the job workers are merged in too.
+def current_metrics():
+    admission_stats = admission.stats()
+    queue = jobs.queue_stats()
+    inference = genre_identify.inference_stats()
+    pool = db_connection.pool
+    return {
+        'admission_running': ('gauge', "Requests running per admission-controlled endpoint",
+                              [({'endpoint': name}, s['running']) for name, s in admission_stats.items()]),
+        'admission_queue_depth': ('gauge', "Requests waiting for admission",
+                                  [({'endpoint': name}, s['queue_depth']) for name, s in admission_stats.items()]),
+        'admission_rejected_total': ('counter', "Requests refused by admission control",
+                                     [({'endpoint': name, 'reason': reason}, s[key])
+                                      for name, s in admission_stats.items()
+                                      for reason, key in (('busy', 'rejected_busy'), ('user', 'rejected_user'),
+                                                          ('timeout', 'timeouts'))]),
+        'job_queue_depth': ('gauge', "Jobs queued or running per kind",
+                            [({'kind': kind, 'status': status}, s[status])
+                             for kind, s in queue.items() for status in (jobs.QUEUED, jobs.RUNNING)]),
+        'inference_queue_depth': ('gauge', "Clips waiting for the genre model",
+                                  [({}, inference['queue_depth'])] if inference else []),
+        'db_pool_connections': ('gauge', "Open database connections of this process",
+                                [({}, pool.created)] if pool is not None else []),
+        'db_pool_timeouts_total': ('counter', "Database connection checkouts that timed out",
+                                   [({}, pool.stats['timeouts'])] if pool is not None else []),
+    }
+
+
+# Prometheus scrape target: stage and request latency histograms with p50/p95/p99, counters and queue depths.
+# Left without a login so the scraper can reach it; restrict it at the proxy if the app is public.
+@admin_blueprint.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.exposition(current_metrics()), mimetype="text/plain; version=0.0.4")
+
+
 @admin_blueprint.route('/admin/update_user_status', methods=['POST'])
 def update_user_status():
     if session.get('username') == 'admin':
@@ -107,7 +194,7 @@ def update_user_status():
         user_id = data.get("user_id")
         new_status = data.get("status")
         try:
-            connection.reconnect()
+            connection = db_connection.get_db_conn()
             cursor = connection.cursor()
             cursor.execute("UPDATE users SET status = %s WHERE u_id = %s", (new_status, user_id))
             connection.commit()
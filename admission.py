@@ -0,0 +1,151 @@
+import itertools
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify, session
+
+# Per-endpoint admission control for the heavy audio endpoints: at most max_concurrent requests run,
+# up to max_queued wait, and anything beyond that is refused straight away instead of making every
+# request slow. Waiting requests are admitted fairly: the user with the fewest running requests goes
+# first, so one user uploading a whole album can't starve everyone else.
+
+
+class Rejected(Exception):
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, name, max_concurrent, max_queued, max_per_user, queue_timeout=30):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user  # Running + waiting requests of one user
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.running = 0
+        self.waiting = []  # [(ticket, user_id)]
+        self.per_user = {}  # user_id -> running + waiting
+        self.running_per_user = {}
+        self.tickets = itertools.count()
+        self.avg_service_time = 1.0  # Moving average in seconds, used for Retry-After
+        self.stats = {'admitted': 0, 'rejected_busy': 0, 'rejected_user': 0, 'timeouts': 0,
+                      'wait_count': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+    def retry_after(self):
+        backlog = self.running + len(self.waiting)
+        return max(1, math.ceil(self.avg_service_time * backlog / self.max_concurrent))
+
+    # The waiting request to admit next: fewest running requests for its user, then arrival order
+    def _next_ticket(self):
+        return min(self.waiting, key=lambda w: (self.running_per_user.get(w[1], 0), w[0]))[0]
+
+    def acquire(self, user_id):
+        start = time.monotonic()
+        with self.condition:
+            if self.per_user.get(user_id, 0) >= self.max_per_user:
+                self.stats['rejected_user'] += 1
+                raise Rejected(429, "Too many requests in progress for this user", self.retry_after())
+            if self.running >= self.max_concurrent and len(self.waiting) >= self.max_queued:
+                self.stats['rejected_busy'] += 1
+                raise Rejected(503, "Server busy, try again later", self.retry_after())
+
+            ticket = next(self.tickets)
+            self.waiting.append((ticket, user_id))
+            self.per_user[user_id] = self.per_user.get(user_id, 0) + 1
+
+            admitted = self.condition.wait_for(
+                lambda: self.running < self.max_concurrent and self._next_ticket() == ticket,
+                timeout=self.queue_timeout)
+            self.waiting.remove((ticket, user_id))
+
+            if not admitted:
+                self._forget_user(user_id)
+                self.stats['timeouts'] += 1
+                self.condition.notify_all()
+                raise Rejected(503, "Server busy, try again later", self.retry_after())
+
+            self.running += 1
+            self.running_per_user[user_id] = self.running_per_user.get(user_id, 0) + 1
+            waited = time.monotonic() - start
+            self.stats['admitted'] += 1
+            self.stats['wait_count'] += 1
+            self.stats['wait_total'] += waited
+            self.stats['wait_max'] = max(self.stats['wait_max'], waited)
+            self.condition.notify_all()  # Another slot may still be free for the next waiter
+        return time.monotonic()
+
+    def release(self, user_id, admitted_at):
+        with self.condition:
+            self.running -= 1
+            self.running_per_user[user_id] -= 1
+            if not self.running_per_user[user_id]:
+                del self.running_per_user[user_id]
+            self._forget_user(user_id)
+            self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * (time.monotonic() - admitted_at)
+            self.condition.notify_all()
+
+    def _forget_user(self, user_id):
+        self.per_user[user_id] -= 1
+        if not self.per_user[user_id]:
+            del self.per_user[user_id]
+
+    def snapshot(self):
+        with self.condition:
+            result = dict(self.stats, running=self.running, queue_depth=len(self.waiting),
+                          max_concurrent=self.max_concurrent, max_queued=self.max_queued,
+                          avg_service_time=round(self.avg_service_time, 3), users=len(self.per_user))
+        result['wait_avg'] = round(result['wait_total'] / result['wait_count'], 4) if result['wait_count'] else 0.0
+        return result
+
+
+controllers = {}
+
+
+def get_controller(name):
+    return controllers[name]
+
+
+def register(name, max_concurrent, max_queued, max_per_user, queue_timeout=30):
+    controllers[name] = AdmissionController(name, max_concurrent, max_queued, max_per_user, queue_timeout)
+    return controllers[name]
+
+
+def rejection_response(error):
+    response = jsonify({"error": str(error)})
+    response.status_code = error.status
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+# View decorator: run the view only once admitted by the named controller
+def limit(name):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            controller = controllers[name]
+            user_id = session.get('u_id')
+            try:
+                admitted_at = controller.acquire(user_id)
+            except Rejected as e:
+                return rejection_response(e)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                controller.release(user_id, admitted_at)
+        return wrapper
+    return decorator
+
+
+def stats():
+    return {name: controller.snapshot() for name, controller in controllers.items()}
+
+
+# Classification runs on the request thread; renders and separations are limited at enqueue time by jobs.py
+register('upload_wav', max_concurrent=4, max_queued=16, max_per_user=3)
+# Excerpt renders are short, so waiting long for one is pointless: a user scrubbing just retries
+register('preview_audio', max_concurrent=4, max_queued=8, max_per_user=2, queue_timeout=5)
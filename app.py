@@ -1,9 +1,9 @@
 from flask import Flask, render_template, request, send_file
-from transformers import Wav2Vec2ForSequenceClassification, Wav2Vec2FeatureExtractor
 import librosa
 import torch
 from pydub import AudioSegment
 import os
+import model_registry
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -35,13 +35,12 @@ equalizer_presets = {
     "International": [2, 1, 0, -1, -2, -3, -4, -5, -6, -7],
 }
 
-# Load model and feature extractor
-genre_classifying_model = Wav2Vec2ForSequenceClassification.from_pretrained("gastonduault/music-classifier")
-feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained("facebook/wav2vec2-large")
+# Model and feature extractor are shared with genre_identify through model_registry (loaded on first use)
 
 # Function to preprocess audio for prediction
 def preprocess_audio(audio_path):
     audio_array, sampling_rate = librosa.load(audio_path, sr=16000)
+    feature_extractor = model_registry.get_feature_extractor()
     return feature_extractor(audio_array, sampling_rate=16000, return_tensors="pt", padding=True)
 
 # Function to apply equalizer preset
@@ -69,8 +68,9 @@ def process():
 
     # Preprocess audio and predict genre
     inputs = preprocess_audio(input_path)  # Converting the audio into a format the model can process
+    inputs = {key: val.to(model_registry.device) for key, val in inputs.items()}
     with torch.no_grad():
-        logits = genre_classifying_model(**inputs).logits
+        logits = model_registry.get_genre_model()(**inputs).logits
         predicted_class = torch.argmax(logits, dim=-1).item()   # predicted_class will have values like 0,1,2,3,4,5....
     predicted_genre = genre_mapping[predicted_class]
 
@@ -87,4 +87,5 @@ def process():
 if __name__ == '__main__':
     os.makedirs("uploads", exist_ok=True)
     os.makedirs("outputs", exist_ok=True)
+    model_registry.warm_up(["genre_model", "feature_extractor"])
     app.run(debug=True)
@@ -0,0 +1,237 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import librosa
+import numpy as np
+import soundfile as sf
+
+import metrics
+
+# Each file is decoded once, at its native sample rate, into a float32 [samples, channels] array.
+# Other sample rates / mono versions are derived from that decode and kept in an in-memory LRU.
+MAX_CACHE_BYTES = 512 * 1024 ** 2
+# Write the native decode to SPILL_FOLDER/<hash of the path>.npy block by block and memory-map it, so it is
+# shared between processes and neither decoding nor reading it holds the whole track in RAM
+SPILL_TO_DISK = True
+SPILL_SUFFIX = ".npy"
+SPILL_FOLDER = os.path.join("cache", "decoded")
+# The least recently used spills are removed beyond this (float32 is about twice the size of a 16-bit WAV)
+MAX_SPILL_BYTES = 8 * 1024 ** 3
+DECODE_BLOCK_FRAMES = 65536
+
+cache = OrderedDict()  # key -> (samples, sr)
+cache_bytes = 0
+cache_lock = threading.Lock()
+decode_locks = {}
+stats = {'hits': 0, 'misses': 0, 'decodes': 0, 'evictions': 0, 'spill_evictions': 0}
+
+
+def file_version(path):
+    info = os.stat(path)
+    return os.path.abspath(path), info.st_mtime_ns, info.st_size
+
+
+def spill_path(path):
+    name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(SPILL_FOLDER, name + SPILL_SUFFIX)
+
+
+def _size(samples):
+    # Memory-mapped arrays live in the page cache, not in our budget
+    return 0 if isinstance(samples, np.memmap) else samples.nbytes
+
+
+def _get_cached(key):
+    with cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            stats['hits'] += 1
+            metrics.count('cache_hits_total', cache="decode")
+            return cache[key]
+        stats['misses'] += 1
+    metrics.count('cache_misses_total', cache="decode")
+    return None
+
+
+def _put_cached(key, value):
+    global cache_bytes
+    with cache_lock:
+        if key in cache:
+            return
+        cache[key] = value
+        cache_bytes += _size(value[0])
+        while cache_bytes > MAX_CACHE_BYTES and len(cache) > 1:
+            _, (samples, _) = cache.popitem(last=False)
+            cache_bytes -= _size(samples)
+            stats['evictions'] += 1
+            metrics.count('cache_evictions_total', cache="decode")
+
+
+# Whole file in RAM, for formats soundfile can't read or when spilling is off
+def _read(path):
+    samples, sr = librosa.load(path, sr=None, mono=False)
+    return np.ascontiguousarray(np.atleast_2d(samples).T, dtype=np.float32)  # [samples, channels]
+
+
+# Decode into a .npy DECODE_BLOCK_FRAMES at a time, so memory use doesn't grow with the track. The blocks are
+# appended with plain writes rather than through a writable memmap, whose dirty pages would count as ours.
+def _spill(path, spilled):
+    os.makedirs(SPILL_FOLDER, exist_ok=True)
+    temp_path = spilled + f".{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with sf.SoundFile(path) as source, open(temp_path, "wb") as f:
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+                                                     'fortran_order': False,
+                                                     'shape': (source.frames, source.channels)})
+            written = 0
+            for block in source.blocks(blocksize=DECODE_BLOCK_FRAMES, dtype="float32", always_2d=True):
+                block = block[:source.frames - written]
+                f.write(np.ascontiguousarray(block).tobytes())
+                written += len(block)
+            if written < source.frames:  # Header promised more frames than the file held
+                f.write(np.zeros((source.frames - written, source.channels), dtype=np.float32).tobytes())
+    except RuntimeError:
+        # Not a format soundfile reads (e.g. some compressed files in a bulk import)
+        with open(temp_path, "wb") as f:
+            np.save(f, _read(path))
+    os.replace(temp_path, spilled)
+    prune_spills(keep=spilled)
+    return np.load(spilled, mmap_mode="r")
+
+
+def _decode(path):
+    with metrics.span("decode"):
+        samples = _spill(path, spill_path(path)) if SPILL_TO_DISK else _read(path)
+    with cache_lock:
+        stats['decodes'] += 1
+    return samples
+
+
+# Remove the least recently used spills until they fit in max_bytes. A spill still mapped by a reader stays
+# readable on POSIX; where it can't be removed it is left for the next prune.
+def prune_spills(max_bytes=MAX_SPILL_BYTES, keep=None):
+    try:
+        names = os.listdir(SPILL_FOLDER)
+    except FileNotFoundError:
+        return
+    spills = []
+    for name in names:
+        if name.endswith(SPILL_SUFFIX):
+            try:
+                info = os.stat(os.path.join(SPILL_FOLDER, name))
+            except OSError:
+                continue
+            spills.append((info.st_mtime, info.st_size, os.path.join(SPILL_FOLDER, name)))
+    total = sum(size for _, size, _ in spills)
+    for _, size, path in sorted(spills):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        with cache_lock:
+            stats['spill_evictions'] += 1
+        metrics.count('cache_evictions_total', cache="decode_spill")
+
+
+# A spill of this version of the file made before, possibly by another worker process
+def _load_spill(path, version):
+    spilled = spill_path(path)
+    try:
+        if os.stat(spilled).st_mtime_ns < version[1]:
+            return None  # The file changed since
+        samples = np.load(spilled, mmap_mode="r")
+        os.utime(spilled)  # Recently used, for prune_spills
+    except (OSError, ValueError):
+        return None  # Not spilled, pruned meanwhile, or cut short
+    return samples
+
+
+def _load_native(path):
+    version = file_version(path)
+    key = (version, None, False)
+    cached = _get_cached(key)
+    if cached is not None:
+        return cached
+
+    with cache_lock:
+        lock = decode_locks.setdefault(version, threading.Lock())
+    with lock:
+        cached = _get_cached(key)
+        if cached is not None:
+            return cached
+
+        sr = librosa.get_samplerate(path)
+        samples = _load_spill(path, version) if SPILL_TO_DISK else None
+        if samples is None:
+            samples = _decode(path)
+
+        _put_cached(key, (samples, sr))
+    with cache_lock:
+        decode_locks.pop(version, None)
+    return samples, sr
+
+
+# Audio of a file as float32: [samples, channels] at the native rate by default,
+# resampled to sr and/or down-mixed to a 1-D array when asked
+def get_audio(path, sr=None, mono=False):
+    samples, native_sr = _load_native(path)
+    if (sr is None or sr == native_sr) and not mono:
+        return samples, native_sr
+
+    key = (file_version(path), sr, mono)
+    cached = _get_cached(key)
+    if cached is not None:
+        return cached
+
+    derived = samples.mean(axis=1) if mono else np.asarray(samples).T
+    target_sr = sr or native_sr
+    if target_sr != native_sr:
+        with metrics.span("resample"):
+            derived = librosa.resample(derived, orig_sr=native_sr, target_sr=target_sr)
+    derived = np.ascontiguousarray(derived if mono else derived.T, dtype=np.float32)
+
+    _put_cached(key, (derived, target_sr))
+    return derived, target_sr
+
+
+# Drop every cached version of a file and its spilled decode (e.g. when the upload is deleted)
+def forget(path, remove_spill=True):
+    global cache_bytes
+    absolute = os.path.abspath(path)
+    with cache_lock:
+        for key in [key for key in cache if key[0][0] == absolute]:
+            samples, _ = cache.pop(key)
+            cache_bytes -= _size(samples)
+    if not remove_spill:
+        return
+    try:
+        os.remove(spill_path(path))
+    except OSError:
+        pass  # Not spilled, or still mapped by another reader
+
+
+# Rename an audio file and keep its decode: the spilled .npy moves with it and the cached entries are re-keyed
+# (a rename keeps mtime and size), so e.g. an upload classified under a temporary name isn't decoded again
+def rename(path, new_path):
+    os.rename(path, new_path)
+    old_absolute, new_absolute = os.path.abspath(path), os.path.abspath(new_path)
+    with cache_lock:
+        for key in [key for key in cache if key[0][0] == old_absolute]:
+            version, sr, mono = key
+            cache[((new_absolute,) + version[1:], sr, mono)] = cache.pop(key)
+    try:
+        os.replace(spill_path(path), spill_path(new_path))
+    except OSError:
+        pass  # Never decoded, or not spilled
+
+
+def cache_stats():
+    with cache_lock:
+        return dict(stats, entries=len(cache), bytes=cache_bytes)
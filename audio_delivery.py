@@ -0,0 +1,47 @@
+import mimetypes
+import os
+
+import soundfile as sf
+from flask import abort, send_from_directory
+
+# Audio files are served through one endpoint instead of as plain static files, so the players can seek
+# with HTTP Range requests (206 partial content) and revalidate with ETag / Last-Modified (304) instead of
+# downloading the whole WAV again. send_from_directory hands the open file to the server's
+# wsgi.file_wrapper, which uses sendfile where the server supports it (or X-Sendfile with USE_X_SENDFILE).
+AUDIO_FOLDERS = {
+    'original': os.path.join("static", "audios", "original"),
+    'rendered': os.path.join("static", "audios", "rendered"),
+    'stems': os.path.join("static", "audios", "splitter_output"),
+}
+MAX_AGE = 0  # Always revalidate, which is cheap: a 304 with no body while the file is unchanged
+
+# Not known to every Python's mimetypes table
+mimetypes.add_type("audio/flac", ".flac")
+mimetypes.add_type("audio/ogg", ".opus")
+
+
+def send_audio(kind, filename, download=False):
+    if kind not in AUDIO_FOLDERS:
+        abort(404)
+    # Resolves filename safely inside the folder and 404s when it doesn't exist
+    return send_from_directory(os.path.abspath(AUDIO_FOLDERS[kind]), filename, conditional=True, etag=True,
+                               max_age=MAX_AGE, as_attachment=download)
+
+
+# Size in bytes and duration in seconds of an audio file, stored with the rendering when it is made
+# so pages don't have to stat or open the file on every load
+def file_metadata(path):
+    try:
+        duration = sf.info(path).duration
+    except RuntimeError:
+        duration = None
+    return os.path.getsize(path), duration
+
+
+def format_size(size_bytes):
+    return f'{size_bytes / (1024 * 1024):.2f} MB'
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return f'{minutes}:{seconds:02d}'
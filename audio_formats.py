@@ -0,0 +1,93 @@
+import io
+import os
+
+import numpy as np
+import soundfile as sf
+import soxr
+
+import metrics
+
+# Renders and stems are stored as lossless FLAC (about half the size of 16-bit WAV). Lossy preview
+# variants for streaming are encoded the first time a client asks for one, on the job workers, and
+# kept next to the FLAC file: EQ_1_x.flac -> EQ_1_x.opus / EQ_1_x.mp3.
+STORAGE_FORMAT = "flac"
+STORAGE_SUBTYPE = "PCM_16"
+
+PREVIEW_FORMATS = {
+    # compression: libsndfile's 0 (best quality) .. 1 (smallest), chosen for roughly 96-128 kbit/s stereo
+    'opus': {'format': 'OGG', 'subtype': 'OPUS', 'samplerates': (48000, 24000, 16000, 12000, 8000),
+             'compression': 0.85},
+    'mp3': {'format': 'MP3', 'subtype': 'MPEG_LAYER_III', 'samplerates': (48000, 44100, 32000),
+            'compression': 0.5},
+}
+BLOCK_SIZE = 65536
+
+
+# Same name with the storage format's extension, e.g. song.wav -> song.flac
+def storage_name(filename):
+    return f"{os.path.splitext(filename)[0]}.{STORAGE_FORMAT}"
+
+
+def variant_path(path, fmt):
+    if fmt == STORAGE_FORMAT:
+        return path
+    if fmt not in PREVIEW_FORMATS:
+        raise ValueError(f"Unknown audio format: {fmt}")
+    return f"{os.path.splitext(path)[0]}.{fmt}"
+
+
+# Formats of path that exist on disk, as stored in renderings.rendered_variants
+def existing_variants(path):
+    formats = [STORAGE_FORMAT] + list(PREVIEW_FORMATS)
+    return ",".join(fmt for fmt in formats if os.path.exists(variant_path(path, fmt)))
+
+
+def remove_variants(path):
+    for fmt in PREVIEW_FORMATS:
+        preview = variant_path(path, fmt)
+        if os.path.exists(preview):
+            os.remove(preview)
+
+
+# Encode [samples, channels] audio in memory, e.g. for a response body
+def encode_bytes(samples, sr, fmt=STORAGE_FORMAT):
+    buffer = io.BytesIO()
+    if fmt == STORAGE_FORMAT:
+        sf.write(buffer, samples, sr, format=fmt.upper(), subtype=STORAGE_SUBTYPE)
+    else:
+        spec = PREVIEW_FORMATS[fmt]
+        sf.write(buffer, samples, sr, format=spec['format'], subtype=spec['subtype'],
+                 compression_level=spec['compression'])
+    buffer.seek(0)
+    return buffer
+
+
+# Encode a preview of source_path block by block (resampling where the codec needs it), returns its path.
+# The file is written under a temporary name and renamed, so readers never see half an encode.
+@metrics.timed("preview_encode")
+def encode_preview(source_path, fmt):
+    spec = PREVIEW_FORMATS[fmt]
+    output_path = variant_path(source_path, fmt)
+    temp_path = f"{output_path}.{os.getpid()}.tmp"
+
+    with sf.SoundFile(source_path) as source:
+        channels = min(source.channels, 2)
+        rate = source.samplerate if source.samplerate in spec['samplerates'] else spec['samplerates'][0]
+        resampler = soxr.ResampleStream(source.samplerate, rate, channels, dtype="float32") \
+            if rate != source.samplerate else None
+
+        try:
+            with sf.SoundFile(temp_path, "w", samplerate=rate, channels=channels, format=spec['format'],
+                              subtype=spec['subtype'], compression_level=spec['compression']) as output:
+                for block in source.blocks(blocksize=BLOCK_SIZE, dtype="float32", always_2d=True):
+                    block = np.ascontiguousarray(block[:, :channels])
+                    if resampler is not None:
+                        block = resampler.resample_chunk(block)
+                    output.write(block)
+                if resampler is not None:
+                    output.write(resampler.resample_chunk(np.zeros((0, channels), dtype=np.float32), last=True))
+            os.replace(temp_path, output_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return output_path
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import threading
+from functools import lru_cache
+
+import librosa
+import numpy as np
+import torch
+
+import audio_assets
+import metrics
+from hashing import cached_file_sha256
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+N_FFT = 4096
+HOP_LENGTH = 1024
+# STFT frames analysed per block
+ANALYSIS_BLOCK_FRAMES = 256
+# Long tracks only analyse every n-th block so at most this many blocks are transformed
+MAX_ANALYSIS_BLOCKS = 64
+SILENCE_DB = -80.0
+
+# Per track band summaries, keyed by file content hash and analysis parameters
+SUMMARY_FOLDER = "analysis_cache"
+summary_lock = threading.Lock()
+stats = {'hits': 0, 'misses': 0}
+
+
+# [bands, bins] 0/1 matrix marking the FFT bins of each band, built once per (sr, n_fft, bands)
+@lru_cache(maxsize=16)
+def band_matrix(sr, n_fft, bands):
+    freqs = librosa.fft_frequencies(sr=sr, n_fft=n_fft)
+    matrix = np.stack([(freqs >= low) & (freqs < high) for low, high in bands]).astype(np.float32)
+    return torch.tensor(matrix, device=device)
+
+
+# Block stride so that at most max_blocks blocks of the track are analysed
+def frame_stride(num_samples, max_blocks=MAX_ANALYSIS_BLOCKS):
+    total_blocks = max(num_samples - N_FFT, 0) // (ANALYSIS_BLOCK_FRAMES * HOP_LENGTH) + 1
+    return max(1, -(-total_blocks // max_blocks)) if max_blocks else 1
+
+
+# Mono blocks of ANALYSIS_BLOCK_FRAMES STFT frames (overlapping by N_FFT - HOP_LENGTH samples)
+def analysis_blocks(samples, stride=1):
+    block_samples = (ANALYSIS_BLOCK_FRAMES - 1) * HOP_LENGTH + N_FFT
+    step = ANALYSIS_BLOCK_FRAMES * HOP_LENGTH
+    for start in range(0, max(len(samples) - N_FFT, 0) + 1, step * stride):
+        y = np.asarray(samples[start:start + block_samples], dtype=np.float32)
+        if y.ndim == 2:
+            y = y.mean(axis=1)
+        if len(y) < N_FFT:
+            y = np.pad(y, (0, N_FFT - len(y)))
+        yield y
+
+
+# Peak level of each band in dB relative to the loudest bin of the track.
+# Keeps a running per-bin peak across blocks and reduces all bands with one matrix op at the end.
+def analyze_samples(samples, sr, bands, max_blocks=MAX_ANALYSIS_BLOCKS):
+    window = torch.hann_window(N_FFT, device=device)  # Use Hann window to reduce spectral leakage
+    bin_peaks = torch.zeros(N_FFT // 2 + 1, device=device)
+
+    for y in analysis_blocks(samples, frame_stride(len(samples), max_blocks)):
+        S = torch.abs(torch.stft(torch.from_numpy(y).to(device), n_fft=N_FFT, hop_length=HOP_LENGTH,
+                                 center=False, return_complex=True, window=window))
+        bin_peaks = torch.maximum(bin_peaks, S.amax(dim=1))
+
+    matrix = band_matrix(sr, N_FFT, tuple(bands))
+    # Magnitudes are non-negative, so masking with 0 doesn't change the per-band maximum
+    band_peaks = (matrix * bin_peaks).amax(dim=1).cpu().numpy()
+    max_amp = bin_peaks.max().item() + 1e-6
+
+    levels = librosa.amplitude_to_db(band_peaks, ref=max_amp, top_db=None)
+    levels[matrix.sum(dim=1).cpu().numpy() == 0] = SILENCE_DB  # Band above Nyquist
+    return [float(level) for level in levels]
+
+
+def summary_path(content_hash, sr, bands, max_blocks):
+    params = json.dumps([sr, N_FFT, HOP_LENGTH, max_blocks, [list(band) for band in bands]])
+    return os.path.join(SUMMARY_FOLDER, f"{content_hash}_{hashlib.sha1(params.encode()).hexdigest()[:12]}.json")
+
+
+# Band levels of a file, served from the persisted summary when the same audio was analysed before
+def analyze_file(audio_path, bands, max_blocks=MAX_ANALYSIS_BLOCKS):
+    sr = librosa.get_samplerate(audio_path)
+    path = summary_path(cached_file_sha256(audio_path), sr, bands, max_blocks)
+
+    if os.path.exists(path):
+        with open(path) as f:
+            summary = json.load(f)
+        with summary_lock:
+            stats['hits'] += 1
+        metrics.count('cache_hits_total', cache="analysis")
+        return summary['levels']
+
+    with summary_lock:
+        stats['misses'] += 1
+    metrics.count('cache_misses_total', cache="analysis")
+    samples, sr = audio_assets.get_audio(audio_path)
+    with metrics.span("analysis"):
+        levels = analyze_samples(samples, sr, bands, max_blocks)
+
+    os.makedirs(SUMMARY_FOLDER, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({'bands': [list(band) for band in bands], 'sr': sr, 'levels': levels}, f)
+    os.replace(temp_path, path)
+    return levels
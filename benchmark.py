@@ -0,0 +1,389 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import soundfile as sf
+
+import audio_assets
+import band_analysis
+import db_connection
+import reference_data
+import stem_cache
+from hashing import hash_memo, save_stream
+
+# Benchmarks for the upload -> classify -> render -> split pipeline. Tracks are synthesised from a fixed
+# seed (so every run times the same audio), each stage is timed on its own and end to end, and the results
+# are written as JSON to compare between commits:
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py --output after.json --compare before.json   # exits 1 on a regression
+#
+# Every run works in a scratch directory (so the caches start empty) and reads genres and presets from an
+# in-memory SQLite stand-in for MySQL, so no database server is needed. Timings are cold by default: the
+# decode, analysis, hash and stem caches are cleared before every repeat; --warm keeps them.
+SAMPLE_RATE = 44100
+SEED = 1234
+DEFAULT_LENGTHS = (10, 60, 240)
+DEFAULT_CHANNELS = (1, 2)
+DEFAULT_REPEATS = 3
+REGRESSION_THRESHOLD = 1.15  # --compare fails when a stage's median wall time grows by more than this factor
+RSS_SAMPLE_SECONDS = 0.005
+
+GENRES = ["Electronic", "Rock", "Punk", "Experimental", "Hip-Hop", "Folk", "Chiptune / Glitch",
+          "Instrumental", "Pop", "International"]
+STAGES = ["upload", "preprocess_audio", "find_genre", "analyze_audio_levels", "apply_equalizer", "ensemble_eq",
+          "separate_audio_for_source", "end_to_end"]
+MODEL_STAGES = {"preprocess_audio", "find_genre", "end_to_end"}
+
+
+# Deterministic test track: bass line, chords, kick and hi-hat over a little noise, [samples, channels]
+def synth_track(seconds, channels, sr=SAMPLE_RATE, seed=SEED):
+    rng = np.random.default_rng(seed + 1000 * seconds + channels)
+    t = np.arange(int(seconds * sr)) / sr
+    beat = 0.5
+    phase = t % beat
+
+    bass = 0.3 * np.sin(2 * np.pi * 55 * t * (1 + 0.5 * (np.floor(t / 2) % 2)))
+    chords = sum(0.08 * np.sin(2 * np.pi * f * t) for f in (220, 277.2, 329.6)) * (0.6 + 0.4 * np.sin(2 * np.pi * 0.25 * t))
+    kick = 0.6 * np.sin(2 * np.pi * 60 * phase) * np.exp(-phase * 30)
+    hihat_phase = (t + beat / 2) % beat
+    mono = bass + chords + kick
+
+    tracks = []
+    for channel in range(channels):
+        hihat = 0.05 * rng.standard_normal(len(t)) * np.exp(-hihat_phase * 80)
+        noise = 0.005 * rng.standard_normal(len(t))
+        pan = 1.0 - 0.2 * channel  # Slightly different channels
+        tracks.append(mono * pan + hihat + noise)
+    samples = np.stack(tracks, axis=1)
+    return (samples / np.abs(samples).max() * 0.7).astype(np.float32)  # About -3 dBFS peak
+
+
+# ---------- MySQL STAND-IN ------------ #
+# Just enough of mysql.connector's connection/cursor API for the reference data queries, on SQLite
+class StandInCursor:
+    def __init__(self, connection, dictionary=False):
+        self.cursor = connection.cursor()
+        self.dictionary = dictionary
+
+    def execute(self, query, args=()):
+        self.cursor.execute(query.replace("%s", "?"), tuple(args))
+
+    def _row(self, row):
+        if row is None or not self.dictionary:
+            return row
+        return {column[0]: value for column, value in zip(self.cursor.description, row)}
+
+    def fetchone(self):
+        return self._row(self.cursor.fetchone())
+
+    def fetchall(self):
+        return [self._row(row) for row in self.cursor.fetchall()]
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    def close(self):
+        self.cursor.close()
+
+
+class StandInConnection:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def cursor(self, dictionary=False, **kwargs):
+        return StandInCursor(self.connection, dictionary)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def ping(self, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+# Takes the place of db_connection's per-process pool
+class StandInPool:
+    def __init__(self, connection):
+        self.connection = connection
+        self.pid = os.getpid()
+
+    def acquire(self):
+        return self.connection
+
+    def release(self, conn):
+        pass
+
+
+def install_db_standin():
+    from genre_identify import equalizer_presets
+
+    connection = sqlite3.connect(":memory:", check_same_thread=False)
+    connection.execute("CREATE TABLE genres (genre_id INTEGER PRIMARY KEY, genre TEXT)")
+    connection.execute(f"CREATE TABLE eq_levels (genre_id INTEGER PRIMARY KEY, "
+                       f"{', '.join(column + ' REAL' for column in reference_data.EQ_COLUMNS)})")
+    for genre_id, genre in enumerate(GENRES, start=1):
+        connection.execute("INSERT INTO genres VALUES (?, ?)", (genre_id, genre))
+        connection.execute(f"INSERT INTO eq_levels VALUES ({', '.join('?' * 11)})",
+                           [genre_id] + list(equalizer_presets[genre_id]))
+    connection.commit()
+    db_connection.pool = StandInPool(StandInConnection(connection))
+    reference_data.data = None
+
+
+# ---------- MEASUREMENT ------------ #
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # No procfs: lifetime peak, which only shows growth
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Samples the resident set size in the background while a stage runs
+class PeakRss(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak = rss_bytes()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(RSS_SAMPLE_SECONDS):
+            self.peak = max(self.peak, rss_bytes())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, rss_bytes())
+        return self.peak
+
+
+def measure(run, reset, audio_seconds, repeats, verbose=False):
+    walls, cpus, peaks, growths = [], [], [], []
+    quiet = contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO())
+    # One untimed run first, so lazy imports and first-call setup don't land in the first repeat
+    reset()
+    try:
+        with quiet:
+            run()
+    except Exception as e:
+        return {'error': f"{type(e).__name__}: {e}"}
+
+    for _ in range(repeats):
+        reset()
+        baseline = rss_bytes()
+        sampler = PeakRss()
+        sampler.start()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            with quiet:
+                run()
+        except Exception as e:
+            sampler.stop()
+            return {'error': f"{type(e).__name__}: {e}"}
+        walls.append(time.perf_counter() - wall_start)
+        cpus.append(time.process_time() - cpu_start)
+        peak = sampler.stop()
+        peaks.append(peak)
+        growths.append(peak - baseline)
+
+    wall = statistics.median(walls)
+    return {'repeats': repeats, 'wall_median': round(wall, 4), 'wall_min': round(min(walls), 4),
+            'cpu_median': round(statistics.median(cpus), 4), 'peak_rss_mb': round(max(peaks) / 2 ** 20, 1),
+            'rss_growth_mb': round(max(growths) / 2 ** 20, 1),
+            'audio_seconds_per_second': round(audio_seconds / wall, 2) if wall else None}
+
+
+def clear_caches(path):
+    audio_assets.forget(path)
+    hash_memo.clear()
+    for folder in (band_analysis.SUMMARY_FOLDER, stem_cache.CACHE_FOLDER):
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def stage_runner(stage, path, work_dir, split):
+    import ensemble
+    import genre_identify
+
+    upload_path = os.path.join(work_dir, "upload.wav")
+    rendered_path = os.path.join(work_dir, "rendered.flac")
+    stems_dir = os.path.join(work_dir, "stems")
+
+    def upload():
+        with open(path, "rb") as f:
+            save_stream(f, upload_path)
+
+    def classify():
+        result = genre_identify.find_genre(path, reference_data.get_genre_mapping())
+        if result == 'error':
+            raise RuntimeError("find_genre failed")
+
+    def render():
+        if not ensemble.ensemble_eq(path, 1, rendered_path):
+            raise RuntimeError("ensemble_eq failed")
+
+    def end_to_end():
+        upload()
+        result = genre_identify.find_genre(upload_path, reference_data.get_genre_mapping())
+        if result == 'error':
+            raise RuntimeError("find_genre failed")
+        if not ensemble.ensemble_eq(upload_path, result['genre_id'], rendered_path):
+            raise RuntimeError("ensemble_eq failed")
+        if split:
+            separate(upload_path)
+
+    def separate(input_path):
+        import demucs_splitter  # Only needed (and installed) for the split stages
+        demucs_splitter.separate_audio_for_source(input_path, stems_dir, "vocals")
+
+    return {
+        'upload': upload,
+        'preprocess_audio': lambda: genre_identify.preprocess_audio(path),
+        'find_genre': classify,
+        'analyze_audio_levels': lambda: ensemble.analyze_audio_levels(path),
+        'apply_equalizer': lambda: ensemble.apply_equalizer(path, genre_identify.equalizer_presets[1], rendered_path),
+        'ensemble_eq': render,
+        'separate_audio_for_source': lambda: separate(path),
+        'end_to_end': end_to_end,
+    }[stage]
+
+
+def environment():
+    import torch
+
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"), 'python': platform.python_version(),
+            'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'numpy': np.__version__,
+            'torch': torch.__version__, 'torch_threads': torch.get_num_threads(), 'cuda': torch.cuda.is_available()}
+
+
+def run(lengths=DEFAULT_LENGTHS, channel_counts=DEFAULT_CHANNELS, repeats=DEFAULT_REPEATS, stages=None,
+        split=False, warm=False, verbose=False, work_dir=None):
+    import model_registry
+
+    stages = stages or [stage for stage in STAGES if split or stage != "separate_audio_for_source"]
+    repo_dir = os.getcwd()
+    work_dir = work_dir or tempfile.mkdtemp(prefix="genreator-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)  # The caches use relative folders, so they start empty here
+    try:
+        install_db_standin()
+
+        # Model loading is timed once, apart from the stages that use the models
+        models = {}
+        names = ["genre_model", "feature_extractor"] if MODEL_STAGES & set(stages) else []
+        if split or "separate_audio_for_source" in stages:
+            names.append(f"demucs:{model_registry.DEMUCS_MODEL_NAME}")
+        for name in names:
+            start = time.perf_counter()
+            try:
+                with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+                    model_registry.get(name)
+                models[name] = {'load_seconds': round(time.perf_counter() - start, 3)}
+            except Exception as e:
+                models[name] = {'error': f"{type(e).__name__}: {e}"}
+
+        results = []
+        for seconds in lengths:
+            for channels in channel_counts:
+                path = os.path.join(work_dir, f"synth_{seconds}s_{channels}ch.wav")
+                sf.write(path, synth_track(seconds, channels), SAMPLE_RATE, subtype="PCM_16")
+                for stage in stages:
+                    reset = (lambda: None) if warm else (lambda: clear_caches(path))
+                    result = measure(stage_runner(stage, path, work_dir, split), reset, seconds, repeats, verbose)
+                    results.append(dict(stage=stage, seconds=seconds, channels=channels, **result))
+                    print(format_result(results[-1]))
+                clear_caches(path)
+        return {'environment': environment(), 'config': {'lengths': list(lengths), 'channels': list(channel_counts),
+                'repeats': repeats, 'warm': warm, 'split': split, 'sample_rate': SAMPLE_RATE, 'seed': SEED},
+                'models': models, 'results': results}
+    finally:
+        os.chdir(repo_dir)
+
+
+def format_result(result):
+    label = f"{result['stage']:<26} {result['seconds']:>4}s {result['channels']}ch"
+    if 'error' in result:
+        return f"{label}  error: {result['error']}"
+    return (f"{label}  wall {result['wall_median']:.3f}s  cpu {result['cpu_median']:.3f}s  "
+            f"peak {result['peak_rss_mb']:.0f} MB  {result['audio_seconds_per_second']}x realtime")
+
+
+# Median wall time of every stage against a previous run, returns the regressed ones
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    before = {(r['stage'], r['seconds'], r['channels']): r for r in baseline['results'] if 'error' not in r}
+    regressions = []
+    for result in results['results']:
+        old = before.get((result['stage'], result['seconds'], result['channels']))
+        if old is None or 'error' in result:
+            continue
+        ratio = result['wall_median'] / old['wall_median'] if old['wall_median'] else 1.0
+        flag = "  REGRESSION" if ratio > threshold else ""
+        print(f"{result['stage']:<26} {result['seconds']:>4}s {result['channels']}ch  "
+              f"{old['wall_median']:.3f}s -> {result['wall_median']:.3f}s  ({ratio:.2f}x){flag}")
+        if flag:
+            regressions.append(dict(result, baseline_wall_median=old['wall_median'], ratio=round(ratio, 3)))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the upload, classify, render and split stages.")
+    parser.add_argument("--lengths", default=",".join(map(str, DEFAULT_LENGTHS)), help="track lengths in seconds")
+    parser.add_argument("--channels", default=",".join(map(str, DEFAULT_CHANNELS)), help="channel counts")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--stages", default=None, help=f"comma separated subset of: {', '.join(STAGES)}")
+    parser.add_argument("--split", action="store_true", help="include Demucs separation (slow)")
+    parser.add_argument("--warm", action="store_true", help="keep caches between repeats")
+    parser.add_argument("--output", default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="JSON results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--work-dir", default=None, help="scratch directory (default: a new temporary one)")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    stages = args.stages.split(",") if args.stages else None
+    unknown = set(stages or []) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    results = run([int(value) for value in args.lengths.split(",")], [int(value) for value in args.channels.split(",")],
+                  args.repeats, stages, args.split, args.warm, args.verbose, args.work_dir)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.threshold}x")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
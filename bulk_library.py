@@ -0,0 +1,230 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import audio_assets
+import reference_data
+from audio_formats import STORAGE_FORMAT
+
+# Offline ingest of a whole catalogue: walks a directory, classifies every track with find_genre and
+# renders it with its genre's eq_levels preset, outside Flask. Classification (decode + inference) and
+# rendering run in two process pools at the same time, so while one track is being rendered the next
+# ones are already being decoded and classified. The classify workers spill their decode to a scratch
+# folder that the render workers memory-map for the band analysis, so a track is only decoded once;
+# the render itself streams the file from disk.
+#
+# Every finished track is appended to <output>/checkpoint.jsonl; running the same command again skips
+# the tracks already done (and retries failed ones). <output>/manifest.json lists every track at the end.
+#
+#   python bulk_library.py /data/catalogue /data/rendered --classify-workers 1 --render-workers 6
+CHECKPOINT_NAME = "checkpoint.jsonl"
+MANIFEST_NAME = "manifest.json"
+DECODE_CACHE_NAME = ".decode_cache"
+REPORT_EVERY_SECONDS = 10
+
+
+def find_tracks(root, extensions):
+    tracks = []
+    for folder, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().rsplit(".", 1)[-1] in extensions:
+                tracks.append(os.path.relpath(os.path.join(folder, name), root))
+    return tracks
+
+
+# Latest record per track from a previous run
+def load_checkpoint(path):
+    records = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Last line cut short by an interrupted run
+                records[record['path']] = record
+    return records
+
+
+def output_name(track, genre_id):
+    base = os.path.splitext(os.path.basename(track))[0]
+    return os.path.join(os.path.dirname(track), f"EQ_{genre_id}_{base}.{STORAGE_FORMAT}")
+
+
+# Runs once in every worker process
+def init_worker(spill_folder, torch_threads, verbose):
+    import torch
+
+    torch.set_num_threads(torch_threads)
+    audio_assets.SPILL_FOLDER = spill_folder
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")  # find_genre and ensemble narrate every step
+
+
+def classify_track(path, genre_mapping, early_exit):
+    from genre_identify import find_genre
+
+    start = time.perf_counter()
+    result = find_genre(path, genre_mapping, early_exit=early_exit)
+    if result == 'error':
+        raise RuntimeError("Genre identification failed")
+    samples, sr = audio_assets.get_audio(path)  # Already decoded for find_genre
+    duration = round(len(samples) / sr, 3)
+    del samples
+    # Unmap it here; the spilled decode stays on disk for the render worker
+    audio_assets.forget(path, remove_spill=False)
+    return dict(result, duration=duration, classify_seconds=round(time.perf_counter() - start, 3))
+
+
+def render_track(path, output_path, default_levels):
+    import ensemble
+
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    differences = ensemble.preset_differences(ensemble.analyze_audio_levels(path), default_levels)
+    ensemble.apply_equalizer(path, differences, output_path)
+    audio_assets.forget(path)  # The spilled decode isn't needed any more
+    return round(time.perf_counter() - start, 3)
+
+
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.audio_seconds = 0.0
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def add(self, record):
+        if record['status'] == 'ok':
+            self.done += 1
+            self.audio_seconds += record.get('duration') or 0
+        else:
+            self.failed += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        return {'tracks': self.done, 'failed': self.failed, 'remaining': self.total - self.done - self.failed,
+                'elapsed_seconds': round(elapsed, 2), 'tracks_per_second': round(self.done / elapsed, 3) if elapsed else 0,
+                'audio_seconds_per_second': round(self.audio_seconds / elapsed, 2) if elapsed else 0}
+
+    def report(self, force=False):
+        now = time.perf_counter()
+        if force or now - self.last_report >= REPORT_EVERY_SECONDS:
+            self.last_report = now
+            s = self.summary()
+            print(f"{s['tracks'] + s['failed']}/{self.total} tracks ({s['failed']} failed), "
+                  f"{s['tracks_per_second']} tracks/s, {s['audio_seconds_per_second']}x realtime", file=sys.__stdout__)
+
+
+def run(input_dir, output_dir, classify_workers=1, render_workers=None, torch_threads=1,
+        extensions=("wav",), early_exit=False, verbose=False):
+    render_workers = render_workers or max(1, (os.cpu_count() or 2) - classify_workers)
+    os.makedirs(output_dir, exist_ok=True)
+    spill_folder = os.path.join(output_dir, DECODE_CACHE_NAME)
+    os.makedirs(spill_folder, exist_ok=True)
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_NAME)
+
+    # Reference data is read once here and handed to the workers, so they don't need the database
+    genre_mapping = reference_data.get_genre_mapping()
+    eq_levels = {genre_id + 1: reference_data.get_eq_levels(genre_id + 1) for genre_id in genre_mapping}
+
+    tracks = find_tracks(input_dir, {extension.lower().lstrip(".") for extension in extensions})
+    records = load_checkpoint(checkpoint_path)
+    pending = [track for track in tracks if records.get(track, {}).get('status') != 'ok']
+    print(f"{len(tracks)} tracks found, {len(tracks) - len(pending)} already done")
+
+    progress = Progress(len(pending))
+    context = multiprocessing.get_context("spawn")
+    worker_args = (spill_folder, torch_threads, verbose)
+    classify_pool = ProcessPoolExecutor(classify_workers, mp_context=context, initializer=init_worker, initargs=worker_args)
+    render_pool = ProcessPoolExecutor(render_workers, mp_context=context, initializer=init_worker, initargs=worker_args)
+
+    futures = {}  # future -> (stage, track, info)
+    queue = iter(pending)
+    exhausted = False
+
+    def in_flight(stage):
+        return sum(1 for value in futures.values() if value[0] == stage)
+
+    try:
+        with open(checkpoint_path, "a") as checkpoint:
+            def finish(record):
+                records[record['path']] = record
+                checkpoint.write(json.dumps(record) + "\n")
+                checkpoint.flush()
+                progress.add(record)
+                progress.report()
+
+            while True:
+                # Keep both pools busy without classifying far ahead of what the renderers can take
+                while not exhausted and in_flight('classify') < 2 * classify_workers \
+                        and in_flight('render') < 2 * render_workers:
+                    track = next(queue, None)
+                    if track is None:
+                        exhausted = True
+                        break
+                    future = classify_pool.submit(classify_track, os.path.join(input_dir, track), genre_mapping, early_exit)
+                    futures[future] = ('classify', track, {})
+                if not futures:
+                    break
+
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, track, info = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        finish({'path': track, 'status': 'failed', 'stage': stage, 'error': f"{type(e).__name__}: {e}"})
+                        continue
+
+                    if stage == 'classify':
+                        info.update(result)
+                        output = output_name(track, result['genre_id'])
+                        info['output'] = output
+                        future = render_pool.submit(render_track, os.path.join(input_dir, track),
+                                                    os.path.join(output_dir, output), eq_levels[result['genre_id']])
+                        futures[future] = ('render', track, info)
+                    else:
+                        finish(dict(info, path=track, status='ok', render_seconds=result))
+    except KeyboardInterrupt:
+        print("Interrupted, run the same command again to resume", file=sys.__stdout__)
+        raise
+    finally:
+        classify_pool.shutdown(cancel_futures=True)
+        render_pool.shutdown(cancel_futures=True)
+
+        summary = progress.summary()
+        manifest = {'input_dir': os.path.abspath(input_dir), 'output_dir': os.path.abspath(output_dir),
+                    'summary': summary, 'tracks': [records[track] for track in tracks if track in records]}
+        with open(os.path.join(output_dir, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f, indent=2)
+        progress.report(force=True)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify and render a whole directory of tracks.")
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("--classify-workers", type=int, default=1, help="processes running decode + genre model")
+    parser.add_argument("--render-workers", type=int, default=None, help="processes rendering (default: remaining CPUs)")
+    parser.add_argument("--torch-threads", type=int, default=1, help="torch threads per worker process")
+    parser.add_argument("--extensions", default="wav", help="comma separated file extensions to include")
+    parser.add_argument("--early-exit", action="store_true", help="stop classifying a track once the genre is clear")
+    parser.add_argument("--verbose", action="store_true", help="keep the workers' own output")
+    args = parser.parse_args(argv)
+
+    summary = run(args.input_dir, args.output_dir, args.classify_workers, args.render_workers, args.torch_threads,
+                  args.extensions.split(","), args.early_exit, args.verbose)
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
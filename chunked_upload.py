@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import time
+import uuid
+
+from hashing import HASH_CHUNK_SIZE
+
+# Resumable uploads for large WAVs: the client creates an upload, PUTs the file in chunks at increasing
+# offsets and then completes it. Chunks are appended straight to a partial file on the same filesystem as
+# the uploads folder (so completing is just a rename), hashed as they arrive, and the WAV header is checked
+# as soon as enough of it is in, so a non-audio file is refused after its first chunk. After a dropped
+# connection the client asks for the current offset and carries on from there.
+PARTIAL_FOLDER = os.path.join("static", "audios", "original", ".partial")
+CHUNK_SIZE = 8 * 1024 * 1024  # Suggested to clients
+MAX_CHUNK_BYTES = 32 * 1024 * 1024
+MAX_UPLOAD_BYTES = 1024 * 1024 * 1024
+HEADER_LIMIT = 1024 * 1024  # The fmt and data chunks of the WAV must start within this many bytes
+SESSION_TTL = 24 * 3600  # Partial uploads untouched for this long are removed
+
+WAV_FORMATS = {1: 'pcm', 3: 'float', 0xFFFE: 'extensible'}
+WAV_BITS = {8, 16, 24, 32, 64}
+
+UPLOAD_ID = re.compile(r"[0-9a-f]{32}")
+
+# upload_id -> (offset, running sha256), so chunks are hashed once as they arrive
+hashers = {}
+upload_locks = {}
+state_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset  # Where the client should resume, for offset mismatches
+
+
+# Format of a WAV file from its first bytes: None while more bytes are needed, UploadError if it isn't a WAV
+def parse_wav_header(head):
+    if len(head) >= 12 and (head[:4] != b"RIFF" or head[8:12] != b"WAVE"):
+        raise UploadError("Not a WAV file", 415)
+
+    pos = 12
+    fmt = None
+    while pos + 8 <= len(head):
+        chunk_id = head[pos:pos + 4]
+        chunk_size = struct.unpack("<I", head[pos + 4:pos + 8])[0]
+        body = pos + 8
+
+        if chunk_id == b"fmt ":
+            if chunk_size < 16:
+                raise UploadError("Invalid WAV format chunk", 415)
+            if body + 16 > len(head):
+                return None
+            audio_format, channels, sample_rate, _, _, bits = struct.unpack("<HHIIHH", head[body:body + 16])
+            if audio_format not in WAV_FORMATS or not 1 <= channels <= 32 \
+                    or not 8000 <= sample_rate <= 384000 or bits not in WAV_BITS:
+                raise UploadError("Unsupported WAV encoding", 415)
+            fmt = {'format': WAV_FORMATS[audio_format], 'channels': channels, 'sample_rate': sample_rate, 'bits': bits}
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise UploadError("WAV data before format chunk", 415)
+            return dict(fmt, data_offset=body, data_bytes=chunk_size)
+
+        pos = body + chunk_size + (chunk_size & 1)  # Chunks are word aligned
+    return None
+
+
+def data_path(upload_id):
+    return os.path.join(PARTIAL_FOLDER, f"{upload_id}.wav")
+
+
+def _meta_path(upload_id):
+    return os.path.join(PARTIAL_FOLDER, f"{upload_id}.json")
+
+
+def _save_meta(meta):
+    temp_path = f"{_meta_path(meta['upload_id'])}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({key: value for key, value in meta.items() if key != 'offset'}, f)
+    os.replace(temp_path, _meta_path(meta['upload_id']))
+
+
+def _lock_for(upload_id):
+    with state_lock:
+        return upload_locks.setdefault(upload_id, threading.Lock())
+
+
+def _forget(upload_id):
+    with state_lock:
+        hashers.pop(upload_id, None)
+        upload_locks.pop(upload_id, None)
+
+
+def create(user_id, filename, size, fields=None):
+    if size <= 0:
+        raise UploadError("Invalid file size")
+    if size > MAX_UPLOAD_BYTES:
+        raise UploadError(f"File is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB", 413)
+
+    os.makedirs(PARTIAL_FOLDER, exist_ok=True)
+    remove_stale()
+    meta = {'upload_id': uuid.uuid4().hex, 'user_id': user_id, 'filename': filename, 'size': size,
+            'fields': fields or {}, 'created_at': time.time(), 'wav': None}
+    open(data_path(meta['upload_id']), "wb").close()
+    _save_meta(meta)
+    meta['offset'] = 0
+    return meta
+
+
+# Upload state including the current offset; unknown ids and uploads of other users are both "not found"
+def load(upload_id, user_id):
+    if not UPLOAD_ID.fullmatch(upload_id or ""):
+        raise UploadError("Upload not found", 404)
+    try:
+        with open(_meta_path(upload_id)) as f:
+            meta = json.load(f)
+        meta['offset'] = os.path.getsize(data_path(upload_id))
+    except (FileNotFoundError, ValueError):
+        raise UploadError("Upload not found", 404)
+    if meta['user_id'] != user_id:
+        raise UploadError("Upload not found", 404)
+    return meta
+
+
+# Hash state at offset; after a restart (or when another worker took the previous chunk) the bytes on disk are rehashed
+def _hasher(upload_id, offset):
+    with state_lock:
+        state = hashers.get(upload_id)
+    if state and state[0] == offset:
+        return state[1]
+
+    digest = hashlib.sha256()
+    remaining = offset
+    with open(data_path(upload_id), "rb") as f:
+        while remaining:
+            chunk = f.read(min(HASH_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest
+
+
+# Append up to length bytes read from stream at offset, returns the updated upload state
+def append(upload_id, user_id, offset, stream, length):
+    meta = load(upload_id, user_id)
+    if length is None:
+        raise UploadError("Content-Length required", 411)
+    if length > MAX_CHUNK_BYTES:
+        raise UploadError(f"Chunks are limited to {MAX_CHUNK_BYTES // (1024 * 1024)} MB", 413)
+
+    with _lock_for(upload_id):
+        current = os.path.getsize(data_path(upload_id))
+        if offset != current:
+            raise UploadError("Offset does not match the uploaded size", 409, offset=current)
+        if current + length > meta['size']:
+            raise UploadError("Chunk goes past the declared file size", 413)
+
+        digest = _hasher(upload_id, current)
+        written = 0
+        try:
+            with open(data_path(upload_id), "ab") as f:
+                while written < length:
+                    chunk = stream.read(min(HASH_CHUNK_SIZE, length - written))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+        finally:
+            # Whatever arrived before a dropped connection is kept, the client resumes after it
+            with state_lock:
+                hashers[upload_id] = (current + written, digest)
+        meta['offset'] = current + written
+
+        if meta['wav'] is None:
+            with open(data_path(upload_id), "rb") as f:
+                head = f.read(HEADER_LIMIT)
+            try:
+                meta['wav'] = parse_wav_header(head)
+                if meta['wav'] is None and (len(head) >= HEADER_LIMIT or meta['offset'] >= meta['size']):
+                    raise UploadError("No audio data found in WAV header", 415)
+            except UploadError:
+                abort(upload_id, user_id)
+                raise
+            if meta['wav'] is not None:
+                _save_meta(meta)
+    return meta
+
+
+# Finish a fully received upload: returns (partial file path, sha256, upload state).
+# The caller moves the file to its final place (or removes it).
+def complete(upload_id, user_id):
+    meta = load(upload_id, user_id)
+    with _lock_for(upload_id):
+        if meta['offset'] != meta['size']:
+            raise UploadError("Upload is incomplete", 409, offset=meta['offset'])
+        if meta['wav'] is None:
+            raise UploadError("Not a WAV file", 415)
+        content_hash = _hasher(upload_id, meta['offset']).hexdigest()
+        os.remove(_meta_path(upload_id))
+    _forget(upload_id)
+    return data_path(upload_id), content_hash, meta
+
+
+def abort(upload_id, user_id):
+    load(upload_id, user_id)
+    for path in (data_path(upload_id), _meta_path(upload_id)):
+        if os.path.exists(path):
+            os.remove(path)
+    _forget(upload_id)
+
+
+def remove_stale(max_age=SESSION_TTL):
+    cutoff = time.time() - max_age
+    for name in os.listdir(PARTIAL_FOLDER):
+        upload_id = name.split(".", 1)[0]
+        if not name.endswith(".json") or not UPLOAD_ID.fullmatch(upload_id):
+            continue
+        try:
+            # The partial file is touched by every chunk, the metadata only when the upload starts
+            if max(os.path.getmtime(data_path(upload_id)), os.path.getmtime(_meta_path(upload_id))) < cutoff:
+                for path in (data_path(upload_id), _meta_path(upload_id)):
+                    os.remove(path)
+                _forget(upload_id)
+        except FileNotFoundError:
+            pass
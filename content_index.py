@@ -0,0 +1,169 @@
+import os
+
+import audio_assets
+import audio_delivery
+import audio_formats
+import db_connection
+import reference_data
+import schema
+
+# Maps audio content (SHA-256 of the uploaded file) to the stored upload, its detected genre and the
+# renders already made from it per genre preset version, so re-uploads of the same song skip
+# classification and rendering and share the files on disk.
+
+
+# File name of a render of an upload with a preset version; renders are shared by every row of the same audio
+def render_name(original, genre_id, preset_version):
+    return audio_formats.storage_name(f"EQ_{genre_id}_{preset_version}_{original}")
+
+
+def _cursor():
+    schema.ensure_schema()
+    connection = db_connection.get_db_conn()
+    return connection, connection.cursor(dictionary=True)
+
+
+def lookup_upload(content_hash):
+    connection, cursor = _cursor()
+    try:
+        cursor.execute("SELECT * FROM audio_hashes WHERE content_hash = %s", (content_hash,))
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def hash_for_file(stored_file):
+    connection, cursor = _cursor()
+    try:
+        cursor.execute("SELECT content_hash FROM audio_hashes WHERE stored_file = %s", (stored_file,))
+        row = cursor.fetchone()
+        return row['content_hash'] if row else None
+    finally:
+        cursor.close()
+
+
+def record_upload(content_hash, stored_file, genre_id, size_bytes):
+    connection, cursor = _cursor()
+    try:
+        cursor.execute('''REPLACE INTO audio_hashes (content_hash, stored_file, genre_id, size_bytes)
+            VALUES (%s, %s, %s, %s)''', (content_hash, stored_file, genre_id, size_bytes))
+        connection.commit()
+    finally:
+        cursor.close()
+
+
+def lookup_render(content_hash, genre_id, preset_version):
+    connection, cursor = _cursor()
+    try:
+        cursor.execute('''SELECT rendered_file FROM hash_renders
+            WHERE content_hash = %s AND genre_id = %s AND preset_version = %s''',
+                       (content_hash, genre_id, preset_version))
+        row = cursor.fetchone()
+        return row['rendered_file'] if row else None
+    finally:
+        cursor.close()
+
+
+def record_render(content_hash, genre_id, preset_version, rendered_file):
+    connection, cursor = _cursor()
+    try:
+        cursor.execute('''REPLACE INTO hash_renders (content_hash, genre_id, preset_version, rendered_file)
+            VALUES (%s, %s, %s, %s)''', (content_hash, genre_id, preset_version, rendered_file))
+        connection.commit()
+    finally:
+        cursor.close()
+
+
+# Point a renderings row at a render, with the file's metadata and the preset it was made with.
+# The row's previous render is removed if nothing else uses it. Returns the previous file name.
+def assign_render(music_id, rendered_file, rendered_folder, genre_id, preset_version):
+    path = os.path.join(rendered_folder, rendered_file)
+    size_bytes, duration = audio_delivery.file_metadata(path)
+    connection, cursor = _cursor()
+    try:
+        cursor.execute("SELECT rendered FROM renderings WHERE music_id = %s", (music_id,))
+        row = cursor.fetchone()
+        previous = row['rendered'] if row else None
+        cursor.execute('''UPDATE renderings SET rendered = %s, rendered_size = %s, rendered_duration = %s,
+            rendered_variants = %s, render_genre_id = %s, preset_version = %s WHERE music_id = %s''',
+                       (rendered_file, size_bytes, duration, audio_formats.existing_variants(path), genre_id,
+                        preset_version, music_id))
+        connection.commit()
+    finally:
+        cursor.close()
+    if previous and previous != rendered_file:
+        remove_unreferenced(rendered=previous, rendered_folder=rendered_folder)
+    return previous
+
+
+# Rows rendered with genre_id's preset at a version other than preset_version (or an unknown one)
+STALE_CONDITION = '''rendered IS NOT NULL AND rendered != '' AND COALESCE(render_genre_id, genre_id) = %s
+    AND (preset_version IS NULL OR preset_version != %s)'''
+
+
+def stale_renders(genre_id, preset_version, limit, exclude=()):
+    connection, cursor = _cursor()
+    query = f"SELECT music_id, original, rendered FROM renderings WHERE {STALE_CONDITION}"
+    args = [genre_id, preset_version]
+    if exclude:
+        query += f" AND music_id NOT IN ({', '.join(['%s'] * len(exclude))})"
+        args += list(exclude)
+    try:
+        cursor.execute(query + " ORDER BY music_id LIMIT %s", args + [limit])
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def count_stale(genre_id, preset_version):
+    connection, cursor = _cursor()
+    try:
+        cursor.execute(f"SELECT COUNT(*) AS stale FROM renderings WHERE {STALE_CONDITION}", (genre_id, preset_version))
+        return cursor.fetchone()['stale']
+    finally:
+        cursor.close()
+
+
+# Whether a render is still the indexed render of a stored upload at its genre's current preset version,
+# e.g. one of the presets of a batch render that no row points at yet
+def _indexed(cursor, rendered):
+    cursor.execute('''SELECT hr.genre_id, hr.preset_version FROM hash_renders hr
+        JOIN audio_hashes ah ON ah.content_hash = hr.content_hash WHERE hr.rendered_file = %s''', (rendered,))
+    return any(row['preset_version'] == reference_data.get_preset_version(row['genre_id'])
+               for row in cursor.fetchall())
+
+
+# Stored files are shared between renderings rows with the same content. Delete a file (and its index
+# entries) only once no row references it any more and, for a render, it isn't the current render of an
+# upload that is kept. Returns the paths that were removed.
+def remove_unreferenced(original=None, rendered=None, upload_folder="", rendered_folder=""):
+    connection, cursor = _cursor()
+    removed = []
+    try:
+        renders = [rendered] if rendered else []
+        if original:
+            cursor.execute("SELECT COUNT(*) AS refs FROM renderings WHERE original = %s", (original,))
+            if cursor.fetchone()['refs'] == 0:
+                # Renders of this audio no row points at (e.g. the other presets of a batch render) go with it
+                cursor.execute('''SELECT hr.rendered_file FROM hash_renders hr
+                    JOIN audio_hashes ah ON ah.content_hash = hr.content_hash WHERE ah.stored_file = %s''', (original,))
+                renders += [row['rendered_file'] for row in cursor.fetchall()]
+                cursor.execute("DELETE FROM audio_hashes WHERE stored_file = %s", (original,))
+                path = os.path.join(upload_folder, original)
+                if os.path.exists(path):
+                    audio_assets.forget(path)  # Cached decode of the upload
+                    os.remove(path)
+                    removed.append(path)
+        for rendered in dict.fromkeys(renders):
+            cursor.execute("SELECT COUNT(*) AS refs FROM renderings WHERE rendered = %s", (rendered,))
+            if cursor.fetchone()['refs'] == 0 and not _indexed(cursor, rendered):
+                cursor.execute("DELETE FROM hash_renders WHERE rendered_file = %s", (rendered,))
+                path = os.path.join(rendered_folder, rendered)
+                audio_formats.remove_variants(path)  # Previews made from it
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed.append(path)
+        connection.commit()
+    finally:
+        cursor.close()
+    return removed
@@ -1,5 +1,12 @@
+import os
+import queue
+import threading
+import time
 import mysql.connector
 from mysql.connector import Error
+from flask import g, has_app_context
+
+import metrics
 
 db_config = {
     'user': 'root',
@@ -8,22 +15,141 @@ db_config = {
     'database': 'db_genreator'
 }
 
-connection = None  # Initialize connection globally
+POOL_SIZE = 10
+CHECKOUT_TIMEOUT = 5  # Seconds to wait for a free connection before giving up
+HEALTH_CHECK_AFTER = 30  # Ping connections that have been idle longer than this (seconds) when borrowed
+
+
+# Fixed-size pool of MySQL connections shared by all request threads of one process
+class ConnectionPool:
+    def __init__(self, config, size=POOL_SIZE, timeout=CHECKOUT_TIMEOUT, health_check_after=HEALTH_CHECK_AFTER):
+        self.config = dict(config, buffered=True)  # Unread rows must not block the next user of a connection
+        self.size = size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.idle = queue.LifoQueue()  # (connection, returned_at), most recently used first
+        self.created = 0
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.stats = {'checkouts': 0, 'waits': 0, 'timeouts': 0, 'health_checks': 0}
+
+    def acquire(self):
+        try:
+            conn, returned_at = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_create = self.created < self.size
+                if can_create:
+                    self.created += 1
+            if can_create:
+                try:
+                    conn = mysql.connector.connect(**self.config)
+                except Error:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+                self.stats['checkouts'] += 1
+                return conn
+
+            self.stats['waits'] += 1
+            try:
+                conn, returned_at = self.idle.get(timeout=self.timeout)
+            except queue.Empty:
+                self.stats['timeouts'] += 1
+                raise TimeoutError(f"No database connection free after {self.timeout}s")
+
+        if time.monotonic() - returned_at > self.health_check_after:
+            try:
+                conn.ping(reconnect=True, attempts=2, delay=0)
+            except Error:
+                self.discard(conn)
+                raise
+            self.stats['health_checks'] += 1
+
+        self.stats['checkouts'] += 1
+        return conn
+
+    def release(self, conn):
+        try:
+            conn.rollback()  # End any open transaction so the next borrower doesn't see a stale snapshot
+        except Error:
+            self.discard(conn)
+            return
+        self.idle.put((conn, time.monotonic()))
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Error:
+            pass
+        with self.lock:
+            self.created -= 1
+
+
+# Wraps a pooled connection so every query is timed as a "db_query" stage; the rest is passed through
+class TimedConnection:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self.connection.cursor(*args, **kwargs))
 
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class TimedCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        with metrics.span("db_query"):
+            return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        with metrics.span("db_query"):
+            return self.cursor.executemany(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+pool = None
+pool_lock = threading.Lock()
+thread_local = threading.local()
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        # Connections can't be shared with a forked child, give every process its own pool
+        if pool is None or pool.pid != os.getpid():
+            pool = ConnectionPool(db_config)
+    return pool
+
+
+# Borrow a connection for the current request (or, outside a request, for the current thread).
+# It is returned to the pool by close_db_conn at the end of the request.
 def get_db_conn():
-    global connection
-    if connection is None or not connection.is_connected():  # Ensure fresh connection
+    holder = g if has_app_context() else thread_local
+    connection = getattr(holder, 'db_conn', None)
+    if connection is None:
         try:
-            connection = mysql.connector.connect(**db_config)
-            # print("Database connected successfully!")
-        except Error as e:
+            with metrics.span("db_checkout"):
+                connection = TimedConnection(get_pool().acquire())
+        except (Error, TimeoutError) as e:
             print(f"Error connecting to database: {e}")
             return None  # Return None if connection fails
-    return connection  # Always return the connection
-
-def close_db_conn(exception):
-    global connection
-    if connection:
-        connection.close()
-        connection = None
-        print("Database connection closed")
+        holder.db_conn = connection
+    return connection
+
+
+def close_db_conn(exception=None):
+    holder = g if has_app_context() else thread_local
+    connection = getattr(holder, 'db_conn', None)
+    if connection is not None:
+        holder.db_conn = None
+        get_pool().release(connection.connection)
@@ -1,52 +1,161 @@
 import os
+import shutil
+import soundfile as sf
+import torch
 from demucs.apply import apply_model
-from demucs.pretrained import get_model
-from demucs.audio import AudioFile, save_audio
+from demucs.audio import AudioFile
+import metrics
+import model_registry
+import profiling
+import stem_cache
+from audio_formats import STORAGE_FORMAT, STORAGE_SUBTYPE
+from hashing import file_sha256
+from model_registry import DEMUCS_MODEL_NAME
 
 # Constants for folder paths
 INPUT_FOLDER = "splitter_input"
 OUTPUT_FOLDER = "splitter_output"
 
-# Separation functions (pass model to avoid reloading)
-def separate_vocals(input_path, output_dir, model):
+# The track is separated SEGMENT_SECONDS at a time, consecutive segments overlap by
+# OVERLAP_SECONDS and are cross-faded, so memory stays flat however long the file is
+SEGMENT_SECONDS = 30
+OVERLAP_SECONDS = 1
+
+# Torch thread counts for separation on CPU (None keeps torch's default)
+INTRA_OP_THREADS = None
+INTER_OP_THREADS = None
+
+# Parameters passed to apply_model, part of the stem cache key
+SEPARATION_PARAMS = {'shifts': 0, 'split': True, 'overlap': 0.1}
+
+
+# Separation functions (pass model to avoid the registry lookup)
+def separate_vocals(input_path, output_dir, model=None):
     separate_audio_for_source(input_path, output_dir, "vocals", model)
 
-def separate_drums(input_path, output_dir, model):
+def separate_drums(input_path, output_dir, model=None):
     separate_audio_for_source(input_path, output_dir, "drums", model)
 
-def separate_bass(input_path, output_dir, model):
+def separate_bass(input_path, output_dir, model=None):
     separate_audio_for_source(input_path, output_dir, "bass", model)
 
-def separate_other(input_path, output_dir, model):
+def separate_other(input_path, output_dir, model=None):
     separate_audio_for_source(input_path, output_dir, "other", model)
 
-# Core audio separation logic
-def separate_audio_for_source(input_path, output_dir, source_name, model):
+
+def configure_threads(intra_op_threads=INTRA_OP_THREADS, inter_op_threads=INTER_OP_THREADS):
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work has started
+            print("⚠️ Inter-op thread count already fixed for this process")
+
+
+# Stems are stored as 16-bit FLAC (format from the file extension), written incrementally
+def open_stem_writer(path, samplerate, channels=2):
+    return sf.SoundFile(path, "w", samplerate=samplerate, channels=channels, subtype=STORAGE_SUBTYPE)
+
+
+# Append a [channels, length] float tensor to a stem
+def write_frames(writer, tensor):
+    writer.write(tensor.clamp(-1, 1).t().contiguous().numpy())
+
+
+# Read one stereo segment at the model's sample rate, shape [1, 2, length]
+def read_segment(audio_file, start, duration, samplerate):
+    segment = audio_file.read(seek_time=start, duration=duration, streams=0, samplerate=samplerate, channels=2)
+    return segment.unsqueeze(0)
+
+
+# Separate the track segment by segment and stream every source to <output_dir>/<source>.flac.
+# progress(fraction), if given, is called after every segment.
+def separate_streaming(input_path, model, output_dir, segment_seconds=SEGMENT_SECONDS,
+                       overlap_seconds=OVERLAP_SECONDS, progress=None):
+    if overlap_seconds >= segment_seconds:
+        raise ValueError("Overlap must be shorter than the segment")
+
+    samplerate = model.samplerate
+    device = next(model.parameters()).device
+    audio_file = AudioFile(input_path)
+    total_seconds = audio_file.duration()
+
+    overlap = int(overlap_seconds * samplerate)
+    fade_in = torch.linspace(0, 1, overlap) if overlap else None
+    writers = {source_name: open_stem_writer(os.path.join(output_dir, f"{source_name}.{STORAGE_FORMAT}"), samplerate)
+               for source_name in model.sources}
+
+    tail = None  # Last `overlap` samples of the previous segment, waiting to be cross-faded
+    start = 0.0
+    try:
+        while start < total_seconds:
+            segment = read_segment(audio_file, start, segment_seconds, samplerate)
+            if segment.shape[-1] == 0:
+                break
+
+            with metrics.span("demucs_forward"), profiling.model_call("demucs"), torch.no_grad():
+                sources = apply_model(model, segment, device=device, **SEPARATION_PARAMS)[0].cpu()
+
+            if tail is not None:
+                n = min(overlap, sources.shape[-1])
+                sources[..., :n] = tail[..., :n] * (1 - fade_in[:n]) + sources[..., :n] * fade_in[:n]
+
+            is_last = start + segment_seconds >= total_seconds
+            if overlap and not is_last:
+                finished, tail = sources[..., :-overlap], sources[..., -overlap:]
+            else:
+                finished, tail = sources, None
+
+            for i, source_name in enumerate(model.sources):
+                write_frames(writers[source_name], finished[i])
+
+            if progress:
+                progress(min(start + segment_seconds, total_seconds) / total_seconds)
+            start += segment_seconds - overlap_seconds
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+# Run the model once and store every source in the stem cache
+def separate_all_sources(input_path, model, key, progress=None):
+    print(f"🎧 Separating all sources ({', '.join(model.sources)})...")
+    with metrics.span("separation"):
+        stem_cache.store(key, lambda entry_dir: separate_streaming(input_path, model, entry_dir, progress=progress))
+
+
+# Core audio separation logic: serve the stem from the cache, separating all stems on a miss
+def separate_audio_for_source(input_path, output_dir, source_name, model=None, model_name=DEMUCS_MODEL_NAME,
+                              progress=None):
     if not os.path.exists(input_path):
         print("❌ File not found:", input_path)
         return
 
-    # Load and preprocess audio
-    wav = AudioFile(input_path).read(streams=0, samplerate=model.samplerate)
-    ref = wav[0]
+    if model is None:
+        model = model_registry.get_demucs_model(model_name)
 
-    if ref.dim() == 1:
-        ref = ref.unsqueeze(0).repeat(2, 1)  # mono to stereo
-    elif ref.shape[0] == 1:
-        ref = ref.repeat(2, 1)  # 1-channel to 2-channel
+    params = dict(SEPARATION_PARAMS, samplerate=model.samplerate, segment=SEGMENT_SECONDS, overlap_add=OVERLAP_SECONDS,
+                  format=STORAGE_FORMAT)
+    key = stem_cache.cache_key(file_sha256(input_path), model_name, params)
 
-    wav = ref.unsqueeze(0)  # shape: [1, channels, length]
-
-    print(f"🎧 Separating {source_name}...")
-    sources = apply_model(model, wav, shifts=0, split=True, overlap=0.1)[0]
-
-    source_index = model.sources.index(source_name)
-    source = sources[source_index]
+    cached_path = stem_cache.lookup(key, source_name)
+    if cached_path is None:
+        separate_all_sources(input_path, model, key, progress)
+        cached_path = stem_cache.stem_path(key, source_name)
+    else:
+        print(f"♻️ {source_name.capitalize()} served from stem cache")
 
     base_name = os.path.splitext(os.path.basename(input_path))[0]
-    out_path = os.path.join(output_dir, f"{base_name}_{source_name}.wav")
+    out_path = os.path.join(output_dir, f"{base_name}_{source_name}.{STORAGE_FORMAT}")
     os.makedirs(output_dir, exist_ok=True)
-    save_audio(source, out_path, samplerate=model.samplerate)
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    try:
+        os.link(cached_path, out_path)  # Share the cached file instead of copying it
+    except OSError:
+        shutil.copyfile(cached_path, out_path)
 
     print(f"✅ {source_name.capitalize()} saved to {out_path}")
 
@@ -55,8 +164,8 @@ def handle_uploaded_file(uploaded_filename, user_choice):
     input_path = os.path.join(INPUT_FOLDER, uploaded_filename)
     output_path = OUTPUT_FOLDER
 
-    # Load model once
-    model = get_model(name="htdemucs").cuda()  # Use GPU
+    # Loaded once per process and reused by every request
+    model = model_registry.get_demucs_model(DEMUCS_MODEL_NAME)
 
 
     # Use dropdown value to select separation
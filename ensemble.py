@@ -16,58 +16,51 @@
 FREQ_BANDS = [(20, 60), (60, 120), (120, 250), (250, 500), (500, 1000),
               (1000, 2000), (2000, 4000), (4000, 8000), (8000, 16000), (16000, 20000)]
 
-import torch
-from pydub import AudioSegment
-import db_connection
 import numpy as np
-import librosa
+import torch
+import audio_assets
+import band_analysis
+import eq_engine
+import metrics
+import reference_data
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"Using device for ensemble: {device}")
 
-connection2 = db_connection.get_db_conn()
+# Excerpt length of a preview render, in seconds
+PREVIEW_SECONDS = 15
+MAX_PREVIEW_SECONDS = 30
+# Filtering starts this long before the excerpt so the filter state has settled when it begins
+PREVIEW_PREROLL_SECONDS = 0.5
 
 
+# Vectorised analysis with per-track summaries cached by content hash, so re-rendering the same
+# upload with another preset skips analysis
 def analyze_audio_levels(audio_path):
     print("Analyzing the audio levels.")
-    y, sr = librosa.load(audio_path, sr=44100)
-
-    y_tensor = torch.tensor(y, device=device)
-    window = torch.hann_window(4096, device=device)  # Use Hann window to reduce spectral leakage
-    S = torch.abs(torch.stft(
-        y_tensor.to(device),  # Ensure input is on GPU
-        n_fft=4096,
-        return_complex=True,
-        window=torch.hann_window(4096, device=device)  # Move window to GPU
-    ))
+    return band_analysis.analyze_file(audio_path, FREQ_BANDS)
 
-    freqs = librosa.fft_frequencies(sr=sr, n_fft=4096)
 
-    max_amp = torch.max(S) + 1e-6
-    eq_levels = []
+# Differences between a track's measured levels and a preset, in dB per band
+def preset_differences(current_levels, default_levels):
+    return [current - default for current, default in zip(current_levels, default_levels)]
 
-    for band in FREQ_BANDS:
-        idx = np.where((freqs >= band[0]) & (freqs < band[1]))[0]
 
-        if len(idx) > 0:
-            magnitude = torch.max(S[idx, :])
-            db_level = librosa.amplitude_to_db([magnitude.cpu().numpy()], ref=max_amp.cpu().numpy())[0]
-        else:
-            db_level = -80  # Default to silence
-
-        eq_levels.append(float(db_level))
-
-    return eq_levels
+# Filter gains that reproduce the original pydub renderer, which overlaid each band, band-passed and scaled
+# by its difference, back onto the track: the band ends up at (1 + 10^(d/20)) times its level. That is about
+# +6 dB for a difference of 0, close to d for large positive ones and never a cut for negative ones.
+def overlay_gains(differences):
+    return [20 * np.log10(1 + 10 ** (difference / 20)) for difference in differences]
 
 
 def compare_eq_levels(audio_path, genre_id):
     print("Compare Eq called.")
-    if genre_id not in DEFAULT_EQ_LEVELS:
+    default_levels = reference_data.get_eq_levels(genre_id)  # Preset served from the reference data cache
+    if default_levels is None:
         raise ValueError("Invalid genre ID")
 
     current_levels = analyze_audio_levels(audio_path)
-    default_levels = DEFAULT_EQ_LEVELS[genre_id]
-    differences = [current - default for current, default in zip(current_levels, default_levels)]
+    differences = preset_differences(current_levels, default_levels)
 
     return {
         "current_levels": current_levels,
@@ -76,40 +69,77 @@ def compare_eq_levels(audio_path, genre_id):
     }
 
 
+# Render [(output_path, gains_db)] by streaming the file from disk block by block, so memory use doesn't
+# depend on the track's length. Formats soundfile can't read go through the spilled decode instead.
+def render_targets(audio_path, targets):
+    if eq_engine.can_stream(audio_path):
+        eq_engine.equalize_stream_multi(audio_path, targets, FREQ_BANDS)
+    else:
+        samples, sr = audio_assets.get_audio(audio_path)
+        eq_engine.equalize_array_multi(samples, sr, targets, FREQ_BANDS)
+
+
+# All ten band gains are applied in one pass of a cascaded shelf/peaking biquad bank
 def apply_equalizer(audio_path, differences, output_path):
     print("Applying Equalizer.")
-    audio = AudioSegment.from_file(audio_path)
+    render_targets(audio_path, [(output_path, overlay_gains(differences))])
+    print(f"Processed audio saved to: {output_path}")
 
-    for i, (low, high) in enumerate(FREQ_BANDS):
-        gain = differences[i]
-        filtered_band = audio.low_pass_filter(high).high_pass_filter(low)
-        filtered_band = filtered_band.apply_gain(gain)
-        audio = audio.overlay(filtered_band)
 
-    print("Gains applied.")
-    print("Saving the processed file...")
-    audio.export(output_path, format="wav")
-    print(f"Processed audio saved to: {output_path}")
+# Render one track with several genre presets: analysed once, then every preset's filter bank runs over
+# the same blocks in a single pass over the file. renders is [(genre_id, output_path)]. Returns 1 on success.
+@metrics.timed("render_batch")
+def ensemble_eq_batch(audio_path, renders):
+    try:
+        print(f"Batch render of {len(renders)} presets.")
+        current_levels = analyze_audio_levels(audio_path)
+        targets = []
+        for genre_id, output_path in renders:
+            default_levels = reference_data.get_eq_levels(genre_id)
+            if default_levels is None:
+                raise ValueError(f"Invalid genre ID: {genre_id}")
+            targets.append((output_path, overlay_gains(preset_differences(current_levels, default_levels))))
+
+        render_targets(audio_path, targets)
+        return 1
+    except Exception as e:
+        print(f"Error in ensemble_eq_batch: {e}")
+        metrics.count('stage_failures_total', stage="render_batch")
+        return 0
+
+
+# Render only [start, start + duration) seconds with the given band gains, for auditioning a preset before
+# the full render. The decode comes from audio_assets (memory-mapped, so slicing it is free) and preset gains
+# from the cached analysis, so this takes a few tens of milliseconds. Returns (samples, sr).
+def render_excerpt(audio_path, gains_db, start=0.0, duration=PREVIEW_SECONDS):
+    samples, sr = audio_assets.get_audio(audio_path)
+    duration = min(max(duration, 1.0), MAX_PREVIEW_SECONDS)
+
+    first = min(int(max(start, 0.0) * sr), max(len(samples) - int(duration * sr), 0))
+    last = min(first + int(duration * sr), len(samples))
+    preroll = min(int(PREVIEW_PREROLL_SECONDS * sr), first)
 
+    excerpt = np.asarray(samples[first - preroll:last], dtype=np.float32)
+    with metrics.span("eq_filter"):
+        filtered = eq_engine.soft_clip(eq_engine.apply_eq(excerpt, sr, gains_db, FREQ_BANDS))
+    return filtered[preroll:], sr
 
+
+# Band gains the full render applies for a genre's preset
+def preset_gains(audio_path, genre_id):
+    return overlay_gains(compare_eq_levels(audio_path, genre_id)["differences"])
+
+
+@metrics.timed("render")
 def ensemble_eq(audio_path, genre_id, output_path):
     try:
         print("Ensemble Eq called.")
-        connection2.reconnect()
-        cursor = connection2.cursor(dictionary=True)
-        cursor.execute('''SELECT sub_bass, bass, lower_midrange, midrange, upper_midrange, low_treble, treble, 
-        presence, brilliance, air FROM eq_levels WHERE genre_id = %s''', (genre_id,))
-        eq_preset = cursor.fetchone()
-
-        eq_values = list(eq_preset.values())
-        global DEFAULT_EQ_LEVELS
-        DEFAULT_EQ_LEVELS = {genre_id: eq_values}
-
         result = compare_eq_levels(audio_path, genre_id)
         apply_equalizer(audio_path, result["differences"], output_path)
         return 1
     except Exception as e:
         print(f"Error in ensemble_eq: {e}")
+        metrics.count('stage_failures_total', stage="render")
         return 0
 
 
@@ -0,0 +1,188 @@
+import os
+import threading
+import time
+
+import numpy as np
+import soundfile as sf
+from scipy.signal import sosfilt
+
+import metrics
+
+# Gains outside this range are clamped so an extreme preset difference can't blow up the output
+MAX_GAIN_DB = 24.0
+
+# Frames read, filtered and written at a time when streaming a render
+BLOCK_SIZE = 65536
+# When a block would clip, samples above this level are softly compressed into the remaining headroom
+SOFT_CLIP_THRESHOLD = 0.98
+
+
+# Centre frequency and Q of a band given by its edges (low, high) in Hz
+def band_center_and_q(low, high):
+    octaves = np.log2(high / low)
+    return np.sqrt(low * high), np.sqrt(2 ** octaves) / (2 ** octaves - 1)
+
+
+# One biquad per band as second-order sections: a low shelf for the first band, a high shelf for the
+# last one and peaking filters in between (RBJ audio EQ cookbook). Bands with 0 dB gain are skipped.
+def design_band_sos(gains_db, sr, bands):
+    sections = []
+    nyquist = sr / 2
+    last = len(bands) - 1
+
+    for i, ((low, high), gain) in enumerate(zip(bands, gains_db)):
+        gain = float(np.clip(gain, -MAX_GAIN_DB, MAX_GAIN_DB))
+        if gain == 0:
+            continue
+
+        a = 10 ** (gain / 40)
+        if i == 0:
+            f0, kind = min(high, nyquist * 0.9), "low_shelf"
+        elif i == last:
+            f0, kind = min(low, nyquist * 0.9), "high_shelf"
+        else:
+            f0, q = band_center_and_q(low, high)
+            if f0 >= nyquist:
+                continue
+            kind = "peak"
+
+        w0 = 2 * np.pi * f0 / sr
+        cos_w0 = np.cos(w0)
+
+        if kind == "peak":
+            alpha = np.sin(w0) / (2 * q)
+            b = [1 + alpha * a, -2 * cos_w0, 1 - alpha * a]
+            den = [1 + alpha / a, -2 * cos_w0, 1 - alpha / a]
+        else:
+            # Shelf slope S = 1
+            alpha = np.sin(w0) / np.sqrt(2)
+            root = 2 * np.sqrt(a) * alpha
+            if kind == "low_shelf":
+                b = [a * ((a + 1) - (a - 1) * cos_w0 + root),
+                     2 * a * ((a - 1) - (a + 1) * cos_w0),
+                     a * ((a + 1) - (a - 1) * cos_w0 - root)]
+                den = [(a + 1) + (a - 1) * cos_w0 + root,
+                       -2 * ((a - 1) + (a + 1) * cos_w0),
+                       (a + 1) + (a - 1) * cos_w0 - root]
+            else:
+                b = [a * ((a + 1) + (a - 1) * cos_w0 + root),
+                     -2 * a * ((a - 1) + (a + 1) * cos_w0),
+                     a * ((a + 1) + (a - 1) * cos_w0 - root)]
+                den = [(a + 1) - (a - 1) * cos_w0 + root,
+                       2 * ((a - 1) - (a + 1) * cos_w0),
+                       (a + 1) - (a - 1) * cos_w0 - root]
+
+        sections.append(np.concatenate([b, den]) / den[0])
+
+    if not sections:
+        return np.array([[1.0, 0.0, 0.0, 1.0, 0.0, 0.0]])  # Flat preset: pass-through
+    return np.array(sections)
+
+
+# Apply all band gains to a [samples, channels] float array in one cascaded pass.
+# Pass the zi returned by the previous block to filter a stream without seams at block boundaries.
+def apply_eq(samples, sr, gains_db, bands, sos=None, zi=None):
+    if sos is None:
+        sos = design_band_sos(gains_db, sr, bands)
+    if zi is None:
+        return sosfilt(sos, samples, axis=0).astype(np.float32)
+    filtered, zi = sosfilt(sos, samples, axis=0, zi=zi)
+    return filtered.astype(np.float32), zi
+
+
+# Initial (silent) filter state for streaming a [samples, channels] signal through sos
+def initial_state(sos, channels):
+    return np.zeros((sos.shape[0], 2, channels))
+
+
+# Keep boosted peaks below full scale without hard clipping. Blocks that stay within full scale are left
+# untouched, so loud source material isn't altered when the EQ doesn't push it over 1.0.
+def soft_clip(samples, threshold=SOFT_CLIP_THRESHOLD):
+    if not np.any(np.abs(samples) > 1.0):
+        return samples
+    over = np.abs(samples) > threshold
+    if np.any(over):
+        headroom = 1.0 - threshold
+        excess = np.abs(samples[over]) - threshold
+        samples[over] = np.sign(samples[over]) * (threshold + headroom * np.tanh(excess / headroom))
+    return samples
+
+
+# Filter an iterable of [frames, channels] blocks into output_path, carrying the filter state across blocks,
+# so memory use is the same for a 3 minute song and a 2 hour mix
+def equalize_blocks(blocks, sr, channels, output_path, gains_db, bands):
+    equalize_blocks_multi(blocks, sr, channels, [(output_path, gains_db)], bands)
+
+
+# Temporary name of an output in the same folder, keeping the extension soundfile picks the format from
+def _temp_path(output_path):
+    root, extension = os.path.splitext(output_path)
+    return f"{root}.{os.getpid()}.{threading.get_ident()}.tmp{extension}"
+
+
+# Filter the same blocks with several gain curves in one pass, writing one output per (output_path, gains_db).
+# Each block is read and converted once and then run through every curve's filter bank. The outputs are
+# written under a temporary name and moved into place when complete, so a reader never sees a half-written
+# file, and two jobs rendering the same file don't write into each other's output.
+def equalize_blocks_multi(blocks, sr, channels, targets, bands):
+    filters = [design_band_sos(gains_db, sr, bands) for _, gains_db in targets]
+    states = [initial_state(sos, channels) for sos in filters]
+    temp_paths = [_temp_path(output_path) for output_path, _ in targets]
+    outputs = [sf.SoundFile(temp_path, "w", samplerate=sr, channels=channels, subtype="PCM_16")
+               for temp_path in temp_paths]
+
+    # Filtering and encoding alternate block by block, so their time is added up and recorded once
+    filter_seconds = export_seconds = 0.0
+    completed = False
+    try:
+        for block in blocks:
+            for i, ((_, gains_db), sos, output) in enumerate(zip(targets, filters, outputs)):
+                start = time.perf_counter()
+                filtered, states[i] = apply_eq(block, sr, gains_db, bands, sos=sos, zi=states[i])
+                filtered = soft_clip(filtered)
+                filtered_at = time.perf_counter()
+                output.write(filtered)
+                filter_seconds += filtered_at - start
+                export_seconds += time.perf_counter() - filtered_at
+        completed = True
+    finally:
+        start = time.perf_counter()
+        for output in outputs:
+            output.close()
+        export_seconds += time.perf_counter() - start
+        for temp_path, (output_path, _) in zip(temp_paths, targets):
+            if completed:
+                os.replace(temp_path, output_path)
+            else:
+                os.remove(temp_path)
+    metrics.record("eq_filter", filter_seconds)
+    metrics.record("export", export_seconds)
+
+
+# Render a file read from disk block_size frames at a time
+def equalize_stream(input_path, output_path, gains_db, bands, block_size=BLOCK_SIZE):
+    equalize_stream_multi(input_path, [(output_path, gains_db)], bands, block_size)
+
+
+# Several renders of a file read from disk once, see equalize_blocks_multi
+def equalize_stream_multi(input_path, targets, bands, block_size=BLOCK_SIZE):
+    with sf.SoundFile(input_path) as source:
+        blocks = source.blocks(blocksize=block_size, dtype="float32", always_2d=True)
+        equalize_blocks_multi(blocks, source.samplerate, source.channels, targets, bands)
+
+
+# Whether soundfile can read the file, i.e. it can be rendered with equalize_stream
+def can_stream(path):
+    try:
+        sf.info(path)
+    except RuntimeError:
+        return False
+    return True
+
+
+# Several renders of an already decoded (possibly memory-mapped) [samples, channels] array, block_size
+# frames at a time, see equalize_blocks_multi
+def equalize_array_multi(samples, sr, targets, bands, block_size=BLOCK_SIZE):
+    blocks = (np.asarray(samples[start:start + block_size], dtype=np.float32)
+              for start in range(0, len(samples), block_size))
+    equalize_blocks_multi(blocks, sr, samples.shape[1], targets, bands)
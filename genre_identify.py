@@ -1,48 +1,207 @@
-from transformers import Wav2Vec2ForSequenceClassification, Wav2Vec2FeatureExtractor
-import librosa
+import threading
+import numpy as np
 import torch
+import audio_assets
+import metrics
+import model_registry
+import profiling
+from inference_server import MicroBatchServer
+from model_registry import device
 
-# Check if CUDA (GPU) is available, otherwise use CPU
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"Using device for genre identification: {device}")  # Check if GPU is being used
 
-# Load model and feature extractor
-model = Wav2Vec2ForSequenceClassification.from_pretrained("gastonduault/music-classifier")
-feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained("facebook/wav2vec2-large")
+# The classifier and feature extractor are loaded lazily by model_registry on first use
 
-# Move model to GPU (if available)
-model.to(device)
+# Serialises every use of the model: direct calls, whole-track calls and the inference server's batches
+model_lock = threading.Lock()
+# Shared micro-batching server, see start_inference_server()
+inference_server = None
+
+SAMPLE_RATE = 16000
+
+# Windowed classification: the track is cut into fixed-length clips which are
+# classified in batches, so memory stays bounded regardless of track length
+WINDOW_SECONDS = 10
+HOP_SECONDS = 10
+MAX_CLIPS_PER_TRACK = 8
+BATCH_SIZE = 4
+
+# Early exit: start with a few clips from the middle of the track and stop as soon as
+# the margin between the two most likely genres reaches EARLY_EXIT_MARGIN
+EARLY_EXIT_INITIAL_CLIPS = 2
+EARLY_EXIT_MARGIN = 0.35
+
+
+# 16 kHz mono, derived from the shared decode of the file
+def load_audio(audio_path):
+    audio_array, sampling_rate = audio_assets.get_audio(audio_path, sr=SAMPLE_RATE, mono=True)
+    return audio_array
 
 
 # Function for preprocessing audio for prediction
 def preprocess_audio(audio_path):
-    audio_array, sampling_rate = librosa.load(audio_path, sr=16000)
-    return feature_extractor(audio_array, sampling_rate=16000, return_tensors="pt", padding=True)
+    audio_array = load_audio(audio_path)
+    with metrics.span("feature_extraction"):
+        return model_registry.get_feature_extractor()(audio_array, sampling_rate=SAMPLE_RATE,
+                                                      return_tensors="pt", padding=True)
+
+
+# Cut the track into clips of window_seconds, every hop_seconds
+def split_into_clips(audio_array, window_seconds=WINDOW_SECONDS, hop_seconds=HOP_SECONDS,
+                     max_clips=MAX_CLIPS_PER_TRACK):
+    window = int(window_seconds * SAMPLE_RATE)
+    hop = max(1, int(hop_seconds * SAMPLE_RATE))
+
+    if len(audio_array) <= window:
+        return [audio_array]
+
+    starts = list(range(0, len(audio_array) - window + 1, hop))
+    if max_clips and len(starts) > max_clips:
+        # Spread the clips evenly over the whole track instead of only using the intro
+        picks = np.linspace(0, len(starts) - 1, max_clips).round().astype(int)
+        starts = [starts[i] for i in picks]
+
+    return [audio_array[start:start + window] for start in starts]
+
+
+# Forward passes over a list of clips, returns logits of shape [clips, genres]. Clips of different lengths
+# (a track shorter than WINDOW_SECONDS, batched with other requests' clips) go through separate passes:
+# the extractor gives no attention mask, so zero padding would change a short clip's logits.
+def run_model(clips):
+    feature_extractor = model_registry.get_feature_extractor()
+    model = model_registry.get_genre_model()
+    by_length = {}
+    for i, clip in enumerate(clips):
+        by_length.setdefault(len(clip), []).append(i)
+
+    logits = [None] * len(clips)
+    for indices in by_length.values():
+        with metrics.span("feature_extraction"):
+            inputs = feature_extractor([clips[i] for i in indices], sampling_rate=SAMPLE_RATE, return_tensors="pt")
+        inputs = {key: val.to(device) for key, val in inputs.items()}
+        with metrics.span("genre_forward"), profiling.model_call("genre"), torch.no_grad():
+            output = model(**inputs).logits.cpu()
+        for i, row in zip(indices, output):
+            logits[i] = row
+    return torch.stack(logits)
 
 
-def find_genre(audio_path, genre_mapping):
-    try:
-        # Preprocess the audio
-        inputs = preprocess_audio(audio_path)
+# The inference server's batches take model_lock too, so they never use the model at the same time as a
+# whole-track find_genre(windowed=False) call
+def run_model_locked(clips):
+    with model_lock:
+        return run_model(clips)
 
-        if inputs is None:
-            raise ValueError("Invalid input after preprocessing")
 
-        print("Processing audio...")
+# Run the clips through the model batch_size at a time, returns logits of shape [clips, genres].
+# When the inference server is running the clips are batched together with other requests instead.
+def classify_clips(clips, batch_size=BATCH_SIZE):
+    if inference_server is not None and inference_server.running:
+        return inference_server.submit(clips).result()
+
+    logits = []
+    for i in range(0, len(clips), batch_size):
+        with model_lock:
+            logits.append(run_model(clips[i:i + batch_size]))
+    return torch.cat(logits, dim=0)
+
+
+def inference_stats():
+    if inference_server is None:
+        return {}
+    return dict(inference_server.stats, queue_depth=inference_server.queue_depth(), running=inference_server.running)
+
+
+# Start the shared micro-batching server used by classify_clips (idempotent)
+def start_inference_server(max_batch_size=BATCH_SIZE * 2, max_wait_ms=15):
+    global inference_server
+    with model_lock:
+        if inference_server is None:
+            inference_server = MicroBatchServer(run_model_locked, max_batch_size, max_wait_ms, name="genre")
+        inference_server.start()
+    return inference_server
 
-        # Move input tensors to the same device as the model (GPU if available)
-        inputs = {key: val.to(device) for key, val in inputs.items()}
 
-        # Predict genre
-        with torch.no_grad():
-            logits = model(**inputs).logits
-            predicted_class = torch.argmax(logits, dim=-1).item()
+# Combine the per clip logits into one score per genre ("mean" of probabilities or majority "vote")
+def aggregate_logits(logits, method="mean"):
+    if method == "vote":
+        votes = torch.bincount(torch.argmax(logits, dim=-1), minlength=logits.shape[-1])
+        return votes.float() / logits.shape[0]
+    if method == "mean":
+        return torch.softmax(logits, dim=-1).mean(dim=0)
+    raise ValueError(f"Unknown aggregation method: {method}")
+
+
+# Difference between the best and the second best genre score
+def score_margin(scores):
+    if scores.shape[-1] < 2:
+        return 1.0
+    top2 = torch.topk(scores, 2).values
+    return (top2[0] - top2[1]).item()
+
+
+# Clip indices ordered from the middle of the track outwards
+def middle_out_order(count):
+    middle = (count - 1) / 2
+    return sorted(range(count), key=lambda i: (abs(i - middle), i))
+
+
+# Classify the most representative clips first and only look at more of the track while unsure
+def classify_with_early_exit(clips, aggregate="mean", margin_threshold=EARLY_EXIT_MARGIN,
+                             initial_clips=EARLY_EXIT_INITIAL_CLIPS, batch_size=BATCH_SIZE):
+    ordered = [clips[i] for i in middle_out_order(len(clips))]
+
+    logits = classify_clips(ordered[:initial_clips], batch_size)
+    scores = aggregate_logits(logits, aggregate)
+    evaluated = min(initial_clips, len(ordered))
+
+    while evaluated < len(ordered) and score_margin(scores) < margin_threshold:
+        batch = ordered[evaluated:evaluated + batch_size]
+        logits = torch.cat([logits, classify_clips(batch, batch_size)], dim=0)
+        scores = aggregate_logits(logits, aggregate)
+        evaluated += len(batch)
+
+    return scores, evaluated
+
+
+@metrics.timed("classify")
+def find_genre(audio_path, genre_mapping, windowed=True, window_seconds=WINDOW_SECONDS,
+               hop_seconds=HOP_SECONDS, max_clips=MAX_CLIPS_PER_TRACK, aggregate="mean",
+               early_exit=False, margin_threshold=EARLY_EXIT_MARGIN, initial_clips=EARLY_EXIT_INITIAL_CLIPS):
+    try:
+        print("Processing audio...")
 
+        if windowed:
+            clips = split_into_clips(load_audio(audio_path), window_seconds, hop_seconds, max_clips)
+            if early_exit:
+                scores, clips_evaluated = classify_with_early_exit(clips, aggregate, margin_threshold, initial_clips)
+            else:
+                scores = aggregate_logits(classify_clips(clips), aggregate)
+                clips_evaluated = len(clips)
+        else:
+            # Whole track in a single forward pass
+            inputs = preprocess_audio(audio_path)
+
+            if inputs is None:
+                raise ValueError("Invalid input after preprocessing")
+
+            # Move input tensors to the same device as the model (GPU if available)
+            inputs = {key: val.to(device) for key, val in inputs.items()}
+
+            # Predict genre
+            with model_lock, metrics.span("genre_forward"), profiling.model_call("genre"), torch.no_grad():
+                logits = model_registry.get_genre_model()(**inputs).logits.cpu()
+            scores = torch.softmax(logits, dim=-1)[0]
+            clips_evaluated = 1
+
+        predicted_class = torch.argmax(scores, dim=-1).item()
         predicted_genre = genre_mapping.get(predicted_class, "error")
-        return {'genre_id': predicted_class + 1, 'genre': predicted_genre}
+        return {'genre_id': predicted_class + 1, 'genre': predicted_genre, 'clips_evaluated': clips_evaluated,
+                'confidence': round(scores[predicted_class].item(), 4), 'margin': round(score_margin(scores), 4)}
 
     except Exception as e:
         print(f"Error processing audio: {e}")
+        metrics.count('stage_failures_total', stage="classify")
         return "error"
 
 
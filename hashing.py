@@ -0,0 +1,46 @@
+import hashlib
+import os
+import threading
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+# SHA-256 of a file's content, read in chunks so large uploads aren't loaded into memory
+def file_sha256(path, chunk_size=HASH_CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Copy a stream (e.g. an uploaded file) to path chunk by chunk, hashing it on the way.
+# Returns (sha256 hex digest, size in bytes).
+def save_stream(stream, path, chunk_size=HASH_CHUNK_SIZE):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "wb") as f:
+        for chunk in iter(lambda: stream.read(chunk_size), b""):
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+# Content hashes memoised per (path, mtime, size), so a file is only read once while it is unchanged
+hash_memo = {}
+hash_memo_lock = threading.Lock()
+
+
+def cached_file_sha256(path):
+    info = os.stat(path)
+    key = (os.path.abspath(path), info.st_mtime_ns, info.st_size)
+    with hash_memo_lock:
+        if key in hash_memo:
+            return hash_memo[key]
+    digest = file_sha256(path)
+    with hash_memo_lock:
+        if len(hash_memo) > 10000:
+            hash_memo.clear()
+        hash_memo[key] = digest
+    return digest
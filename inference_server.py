@@ -0,0 +1,107 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+# Default micro-batching limits
+MAX_BATCH_SIZE = 8
+MAX_WAIT_MS = 15
+
+
+# Queues classification requests coming from all request threads and runs them through the
+# model in micro-batches on a single worker thread, so the torch module is never used concurrently.
+# run_batch(items) must return a tensor with one row per item.
+class MicroBatchServer:
+    def __init__(self, run_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, name="inference"):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.requests = queue.Queue()
+        self.thread = None
+        self.running = False
+        self.stats = {'requests': 0, 'batches': 0, 'items': 0, 'failures': 0}
+
+    def start(self):
+        if self.running:
+            return self
+        self.running = True
+        self.thread = threading.Thread(target=self._serve, name=f"{self.name}-server", daemon=True)
+        self.thread.start()
+        print(f"Started {self.name} server (max batch {self.max_batch_size}, max wait {self.max_wait * 1000:.0f} ms)")
+        return self
+
+    def stop(self):
+        self.running = False
+        self.requests.put(None)  # Wake up the worker
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        # Fail whatever is still queued instead of leaving callers waiting forever
+        while not self.requests.empty():
+            request = self.requests.get_nowait()
+            if request is not None:
+                request[1].set_exception(RuntimeError(f"{self.name} server stopped"))
+
+    # Returns a Future that resolves to the rows of the output belonging to these items
+    def submit(self, items):
+        future = Future()
+        if not items:
+            future.set_exception(ValueError("Nothing to classify"))
+            return future
+        if not self.running:
+            future.set_exception(RuntimeError(f"{self.name} server is not running"))
+            return future
+        self.requests.put((list(items), future))
+        return future
+
+    def queue_depth(self):
+        return self.requests.qsize()
+
+    # Collect requests until the batch is full or the latency budget of the first request is used up
+    def _collect(self, first):
+        pending = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                break
+            pending.append(request)
+            size += len(request[0])
+        return pending
+
+    def _serve(self):
+        while self.running:
+            first = self.requests.get()
+            if first is None:
+                continue
+            pending = self._collect(first)
+            items = [item for request_items, _ in pending for item in request_items]
+
+            try:
+                # A single request may be larger than max_batch_size, keep each forward pass bounded
+                outputs = torch.cat([self.run_batch(items[i:i + self.max_batch_size])
+                                     for i in range(0, len(items), self.max_batch_size)], dim=0)
+            except Exception as e:
+                self.stats['failures'] += 1
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+
+            self.stats['requests'] += len(pending)
+            self.stats['batches'] += 1
+            self.stats['items'] += len(items)
+
+            offset = 0
+            for request_items, future in pending:
+                future.set_result(outputs[offset:offset + len(request_items)])
+                offset += len(request_items)
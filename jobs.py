@@ -0,0 +1,430 @@
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import metrics
+import profiling
+
+# Renders and separations run as jobs on a pool of worker processes (so torch work doesn't fight the
+# request threads for the GIL). Job state lives in a local SQLite database so it survives a restart.
+JOB_DB = os.path.join("cache", "jobs.sqlite3")
+JOB_WORKERS = 2
+MAX_PENDING_JOBS = 32  # Queued + running jobs accepted before enqueue is refused
+# Backpressure per job kind and per user (so one user queueing a whole album can't starve the others)
+MAX_PENDING_PER_KIND = {'render': 24, 'render_batch': 8, 'split': 8, 'preview': 16, 'rerender': 16}
+MAX_PENDING_PER_USER = 4
+# Background kinds that run one at a time on their own worker process, so they never take a JOB_WORKERS slot
+SERIAL_KINDS = {'rerender'}
+SERIAL_WAIT_SECONDS = 5  # Poll interval while another web worker's job of a serial kind is running
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+executor = None
+serial_executor = None
+executor_lock = threading.Lock()
+
+
+class JobQueueFull(Exception):
+    status = 503
+
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UserQuotaExceeded(JobQueueFull):
+    status = 429
+
+
+# Short-lived connection per operation: commits on success, always closed
+@contextmanager
+def _connect():
+    os.makedirs(os.path.dirname(JOB_DB), exist_ok=True)
+    conn = sqlite3.connect(JOB_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def init_db():
+    with _connect() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            user_id INTEGER,
+            status TEXT NOT NULL,
+            progress REAL NOT NULL DEFAULT 0,
+            params TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            owner_pid INTEGER,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+
+def get_job(job_id):
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+
+def pending_count(kind=None, user_id=None):
+    query = "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)"
+    args = [QUEUED, RUNNING]
+    if kind:
+        query += " AND kind = ?"
+        args.append(kind)
+    if user_id is not None:
+        query += " AND user_id = ?"
+        args.append(user_id)
+    with _connect() as conn:
+        return conn.execute(query, args).fetchone()[0]
+
+
+# Queue depth and timings per job kind over the last `recent` finished jobs
+def queue_stats(recent=50):
+    init_db()  # Also asked for (by /metrics) before the first job was queued
+    result = {}
+    with _connect() as conn:
+        for kind in HANDLERS:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs WHERE kind = ? GROUP BY status",
+                                       (kind,)).fetchall())
+            timings = conn.execute('''SELECT AVG(started_at - created_at), MAX(started_at - created_at),
+                AVG(finished_at - started_at) FROM (SELECT * FROM jobs WHERE kind = ? AND status = ?
+                ORDER BY finished_at DESC LIMIT ?)''', (kind, DONE, recent)).fetchone()
+            result[kind] = {'queued': counts.get(QUEUED, 0), 'running': counts.get(RUNNING, 0),
+                            'done': counts.get(DONE, 0), 'failed': counts.get(FAILED, 0),
+                            'wait_avg': round(timings[0] or 0, 3), 'wait_max': round(timings[1] or 0, 3),
+                            'run_avg': round(timings[2] or 0, 3)}
+    return result
+
+
+# Most recent jobs of a kind, newest first
+def recent_jobs(kind, limit=10):
+    with _connect() as conn:
+        rows = conn.execute("SELECT job_id FROM jobs WHERE kind = ? ORDER BY created_at DESC LIMIT ?",
+                            (kind, limit)).fetchall()
+    return [get_job(row['job_id']) for row in rows]
+
+
+# Id of a queued or running job of this kind whose params include the given values, or None
+def pending_job(kind, **match):
+    with _connect() as conn:
+        rows = conn.execute("SELECT job_id, params FROM jobs WHERE kind = ? AND status IN (?, ?)",
+                            (kind, QUEUED, RUNNING)).fetchall()
+    for row in rows:
+        params = json.loads(row['params'])
+        if all(params.get(key) == value for key, value in match.items()):
+            return row['job_id']
+    return None
+
+
+# Rough seconds until a newly queued job of this kind would start
+def estimated_wait(kind):
+    stats = queue_stats().get(kind, {})
+    backlog = stats.get('queued', 0) + stats.get('running', 0)
+    return max(1, round((stats.get('run_avg') or 5) * backlog / JOB_WORKERS))
+
+
+def set_progress(job_id, progress):
+    with _connect() as conn:
+        conn.execute("UPDATE jobs SET progress = ? WHERE job_id = ?", (round(min(max(progress, 0), 1), 3), job_id))
+
+
+def _finish(job_id, status, result=None, error=None):
+    with _connect() as conn:
+        conn.execute("UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE job_id = ?",
+                     (status, json.dumps(result) if result is not None else None, error, time.time(), job_id))
+        if status == DONE:
+            conn.execute("UPDATE jobs SET progress = 1 WHERE job_id = ?", (job_id,))
+
+
+def get_executor():
+    global executor, serial_executor
+    with executor_lock:
+        if executor is None:
+            init_db()
+            # spawn: forking a process that holds torch threads and DB connections is not safe
+            context = multiprocessing.get_context("spawn")
+            executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=context)
+            serial_executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+            recover_jobs()
+    return executor
+
+
+def _submit(job_id, kind):
+    pool = serial_executor if kind in SERIAL_KINDS else executor
+    pool.submit(run_job, job_id).add_done_callback(metrics.merge_job_future)
+
+
+# Create the worker pool at startup so jobs left queued or interrupted by a restart are resumed straight
+# away, not when the next job is queued. Skipped in a worker process, which imports the app's main module.
+def start():
+    if multiprocessing.parent_process() is not None:
+        return None
+    return get_executor()
+
+
+# Add a job and hand it to the worker pool, returns the job id
+def enqueue(kind, params, user_id=None):
+    if kind not in HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    get_executor()
+    if user_id is not None and pending_count(user_id=user_id) >= MAX_PENDING_PER_USER:
+        raise UserQuotaExceeded("Too many jobs in progress for this user", estimated_wait(kind))
+    if pending_count() >= MAX_PENDING_JOBS or pending_count(kind) >= MAX_PENDING_PER_KIND.get(kind, MAX_PENDING_JOBS):
+        raise JobQueueFull("Too many jobs waiting, try again later", estimated_wait(kind))
+
+    job_id = uuid.uuid4().hex
+    profile = profiling.job_options()  # Set when the request queueing the job is being profiled
+    if profile:
+        params = dict(params, profile=profile)
+    with _connect() as conn:
+        conn.execute("INSERT INTO jobs (job_id, kind, user_id, status, params, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                     (job_id, kind, user_id, QUEUED, json.dumps(params), time.time()))
+    _submit(job_id, kind)
+    return job_id
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+# Requeue jobs left behind by a previous web worker: queued ones were never run and running ones
+# whose worker process is gone were interrupted. Jobs are claimed atomically, so a job submitted
+# by several web workers still only runs once.
+def recover_jobs():
+    with _connect() as conn:
+        rows = conn.execute("SELECT job_id, kind, status, owner_pid FROM jobs WHERE status IN (?, ?)",
+                            (QUEUED, RUNNING)).fetchall()
+        orphaned = [row['job_id'] for row in rows
+                    if row['status'] == RUNNING and not (row['owner_pid'] and _pid_alive(row['owner_pid']))]
+        conn.executemany("UPDATE jobs SET status = ?, progress = 0, owner_pid = NULL WHERE job_id = ?",
+                         [(QUEUED, job_id) for job_id in orphaned])
+
+    resubmit = [row for row in rows if row['status'] == QUEUED or row['job_id'] in orphaned]
+    for row in resubmit:
+        _submit(row['job_id'], row['kind'])
+    if resubmit:
+        print(f"Recovered {len(resubmit)} unfinished job(s)")
+
+
+# Mark a queued job as running in this process. A job of a serial kind is only claimed while no other job
+# of that kind runs in a live process, which also holds across web workers sharing the job database.
+# Returns "claimed", "busy" (try again later) or "taken" (already claimed elsewhere, or gone).
+def _claim(job_id, kind):
+    with _connect() as conn:
+        conn.execute("BEGIN IMMEDIATE")  # The check and the claim must not interleave with another claim
+        if kind in SERIAL_KINDS:
+            owners = conn.execute("SELECT owner_pid FROM jobs WHERE kind = ? AND status = ? AND job_id != ?",
+                                  (kind, RUNNING, job_id)).fetchall()
+            if any(row['owner_pid'] and _pid_alive(row['owner_pid']) for row in owners):
+                return "busy"
+        claimed = conn.execute("UPDATE jobs SET status = ?, owner_pid = ?, started_at = ? WHERE job_id = ? AND status = ?",
+                               (RUNNING, os.getpid(), time.time(), job_id, QUEUED)).rowcount
+    return "claimed" if claimed else "taken"
+
+
+# Runs in a worker process. Returns the metrics recorded while running, merged by the web process.
+def run_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return None
+    claim = _claim(job_id, job['kind'])
+    while claim == "busy":
+        time.sleep(SERIAL_WAIT_SECONDS)
+        claim = _claim(job_id, job['kind'])
+    if claim == "taken":
+        return None  # Already taken by another worker
+
+    job = get_job(job_id)
+    metrics.observe('job_wait_seconds', job['started_at'] - job['created_at'], kind=job['kind'])
+    start = time.perf_counter()
+    try:
+        with profiling.job_profile(job['params'].pop('profile', None), job['kind'], job_id):
+            result = HANDLERS[job['kind']](job['params'], lambda progress: set_progress(job_id, progress))
+        _finish(job_id, DONE, result=result)
+        metrics.count('jobs_total', kind=job['kind'], status=DONE)
+    except Exception as e:
+        print(f"Job {job_id} ({job['kind']}) failed: {e}")
+        _finish(job_id, FAILED, error=str(e))
+        metrics.count('jobs_total', kind=job['kind'], status=FAILED)
+    metrics.observe('job_seconds', time.perf_counter() - start, kind=job['kind'])
+    return metrics.drain()
+
+
+def render_job(params, progress):
+    import content_index
+    import db_connection
+    from ensemble import ensemble_eq
+
+    progress(0.05)
+    if not ensemble_eq(params['source_path'], int(params['genre_id']), params['output_path']):
+        raise RuntimeError("Error generating audio")
+    progress(0.95)
+
+    try:
+        # Later uploads of the same audio reuse this render
+        content_index.record_render(params['content_hash'], params['genre_id'], params['preset_version'],
+                                    params['output_name'])
+        content_index.assign_render(params['music_id'], params['output_name'], os.path.dirname(params['output_path']),
+                                    params['genre_id'], params['preset_version'])
+    finally:
+        db_connection.close_db_conn()
+    return {'file': params['output_name']}
+
+
+# Several presets of one track in one pass; the renders are indexed for reuse but no row is changed,
+# generate_audio assigns the one the user picks without rendering again
+def render_batch_job(params, progress):
+    import content_index
+    import db_connection
+    from ensemble import ensemble_eq_batch
+
+    progress(0.05)
+    renders = params['renders']
+    if not ensemble_eq_batch(params['source_path'], [(render['genre_id'], render['output_path']) for render in renders]):
+        raise RuntimeError("Error generating audio")
+    progress(0.95)
+
+    try:
+        for render in renders:
+            content_index.record_render(params['content_hash'], render['genre_id'], render['preset_version'],
+                                        render['output_name'])
+    finally:
+        db_connection.close_db_conn()
+    return {'renders': [{'genre_id': render['genre_id'], 'file': render['output_name']} for render in renders]}
+
+
+# Bring renders made with an older version of a genre's preset up to date after an admin changed it.
+# Works through the stale rows RERENDER_BATCH_SIZE at a time with a pause in between. Re-renders are a
+# SERIAL_KIND: one runs at a time, on its own worker process, so the JOB_WORKERS pool stays free for user
+# jobs even while several genres are being brought up to date. The current preset version is read again
+# for every batch, so a further edit while this runs is picked up too.
+RERENDER_BATCH_SIZE = 4
+RERENDER_PAUSE_SECONDS = 2
+
+
+def rerender_job(params, progress):
+    import audio_delivery
+    import content_index
+    import db_connection
+    import reference_data
+    from ensemble import ensemble_eq
+    from hashing import cached_file_sha256
+
+    genre_id = params['genre_id']
+    upload_folder = audio_delivery.AUDIO_FOLDERS['original']
+    rendered_folder = audio_delivery.AUDIO_FOLDERS['rendered']
+    done, failed = 0, []
+
+    try:
+        while True:
+            preset_version = reference_data.get_preset_version(genre_id)
+            rows = content_index.stale_renders(genre_id, preset_version, RERENDER_BATCH_SIZE, exclude=failed)
+            if preset_version is None or not rows:
+                break
+
+            for row in rows:
+                source_path = os.path.join(upload_folder, row['original'])
+                try:
+                    content_hash = content_index.hash_for_file(row['original']) or cached_file_sha256(source_path)
+                    # Rows sharing the same audio are rendered once, the first one indexes the render for the rest
+                    output_name = content_index.lookup_render(content_hash, genre_id, preset_version)
+                    if not output_name or not os.path.exists(os.path.join(rendered_folder, output_name)):
+                        output_name = content_index.render_name(row['original'], genre_id, preset_version)
+                        if not ensemble_eq(source_path, genre_id, os.path.join(rendered_folder, output_name)):
+                            raise RuntimeError("Error generating audio")
+                        content_index.record_render(content_hash, genre_id, preset_version, output_name)
+                    content_index.assign_render(row['music_id'], output_name, rendered_folder, genre_id, preset_version)
+                    done += 1
+                except Exception as e:
+                    print(f"Re-render of music_id {row['music_id']} failed: {e}")
+                    failed.append(row['music_id'])
+
+            remaining = content_index.count_stale(genre_id, preset_version) - len(failed)
+            progress(done / max(done + remaining, 1))
+            db_connection.close_db_conn()  # Don't hold a pooled connection through the pause
+            time.sleep(RERENDER_PAUSE_SECONDS)
+    finally:
+        db_connection.close_db_conn()
+    return {'genre_id': genre_id, 'rerendered': done, 'failed': failed}
+
+
+def split_job(params, progress):
+    from demucs_splitter import configure_threads, separate_audio_for_source
+
+    configure_threads()
+    try:
+        separate_audio_for_source(params['input_path'], params['output_dir'], params['source_name'], progress=progress)
+    finally:
+        # The input was saved for this job only; stems of the same audio come from the stem cache next time
+        if os.path.exists(params['input_path']):
+            os.remove(params['input_path'])
+    output_path = os.path.join(params['output_dir'], params['output_name'])
+    if not os.path.exists(output_path):
+        raise RuntimeError("Error extracting audio")
+
+    file_size_mb = round(os.path.getsize(output_path) / (1024 * 1024), 2)
+    return {'file': params['output_name'], 'audio_type': params['audio_type'], 'file_size_mb': f'{file_size_mb:.2f} MB'}
+
+
+# Lossy streaming copy of a render or stem, made the first time a client asks for it
+def preview_job(params, progress):
+    import audio_delivery
+    import audio_formats
+    import db_connection
+    import schema
+
+    source_path = os.path.join(audio_delivery.AUDIO_FOLDERS[params['audio_kind']], params['file'])
+    preview_path = audio_formats.variant_path(source_path, params['format'])
+    if not os.path.exists(preview_path):  # Another job may have made it in the meantime
+        audio_formats.encode_preview(source_path, params['format'])
+    progress(0.95)
+
+    if params['audio_kind'] == 'rendered':
+        connection = db_connection.get_db_conn()
+        try:
+            schema.ensure_schema()
+            cursor = connection.cursor()
+            # Renders are shared between rows of the same audio
+            cursor.execute("UPDATE renderings SET rendered_variants = %s WHERE rendered = %s",
+                           (audio_formats.existing_variants(source_path), params['file']))
+            connection.commit()
+            cursor.close()
+        finally:
+            db_connection.close_db_conn()
+    return {'file': os.path.basename(preview_path), 'audio_kind': params['audio_kind'], 'format': params['format']}
+
+
+HANDLERS = {
+    'render': render_job,
+    'render_batch': render_batch_job,
+    'rerender': rerender_job,
+    'split': split_job,
+    'preview': preview_job,
+}
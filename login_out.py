@@ -6,7 +6,7 @@ from werkzeug.utils import secure_filename
 import db_connection
 
 login_out_blueprint = Blueprint('login_out', __name__)
-connection = db_connection.get_db_conn()
+login_out_blueprint.teardown_app_request(db_connection.close_db_conn)  # Return the pooled connection
 
 
 @login_out_blueprint.route('/')
@@ -42,7 +42,7 @@ def register_user():
 
         # Insert into MySQL
         query = "INSERT INTO users (username, email, password, profile_pic, status) VALUES (%s, %s, %s, %s, %s)"
-        connection.reconnect()
+        connection = db_connection.get_db_conn()
         cursor = connection.cursor(dictionary=True)
         values = (username, email, password, profile_pic_filename, status)
         cursor.execute(query, values)
@@ -60,7 +60,7 @@ def login_action():
         username = request.form['username']
         password = request.form['password']
 
-        connection.reconnect()
+        connection = db_connection.get_db_conn()
         cursor = connection.cursor(dictionary=True)
         cursor.execute(
             '''SELECT u_id, username, profile_pic, status FROM users WHERE username = %s AND password = %s''',
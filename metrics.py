@@ -0,0 +1,250 @@
+import bisect
+import json
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, has_request_context, request
+
+# Timing spans and counters for the pipeline stages (decode, feature extraction, model forward, analysis,
+# EQ filtering, export, DB queries, separation), exported in the Prometheus text format by /metrics.
+# Every span goes into a histogram per stage; the p50/p95/p99 are taken over the last WINDOW observations.
+#
+# Job workers are separate processes: run_job returns what the worker recorded with drain() and the web
+# process adds it with merge(), so renders and separations show up in the same histograms.
+PREFIX = "genreator"
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW = 1024  # Recent observations per series used for the quantiles
+
+REQUEST_ID_HEADER = "X-Request-ID"
+# A client supplied id is only used if it matches, since it ends up in logs, headers and profile folder names
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+LOG_REQUESTS = False  # Print one JSON line per request with its id, status, duration and spans
+
+HELP = {
+    'stage_seconds': "Time spent in a pipeline stage",
+    'request_seconds': "Request latency per endpoint",
+    'requests_total': "Requests per endpoint and status",
+    'stage_failures_total': "Pipeline stages that raised an exception",
+    'job_seconds': "Run time of a job on the worker pool",
+    'job_wait_seconds': "Time a job waited in the queue before a worker took it",
+    'jobs_total': "Finished jobs per kind and status",
+    'upload_dedup_total': "Uploads whose audio was already stored (hit) or new (miss)",
+    'render_reuse_total': "Render requests served by an existing render (hit) or queued (miss)",
+    'cache_hits_total': "Cache hits",
+    'cache_misses_total': "Cache misses",
+    'cache_evictions_total': "Entries removed from a cache to stay within its size limit",
+}
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=WINDOW)
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantiles(self):
+        values = sorted(self.recent)
+        if not values:
+            return {}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in QUANTILES}
+
+
+lock = threading.Lock()
+histograms = {}  # (name, labels) -> Histogram, labels as a sorted tuple of (key, value)
+counters = {}  # (name, labels) -> float
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+def count(name, amount=1, **labels):
+    key = _key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+# Time of one stage, e.g. measured in a loop; shows up in the current request's log line as well
+def record(stage, seconds):
+    observe('stage_seconds', seconds, stage=stage)
+    if has_request_context() and hasattr(g, 'spans'):
+        g.spans.append((stage, round(seconds, 4)))
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        count('stage_failures_total', stage=stage)
+        raise
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# p50/p95/p99, count and total per stage, for the admin load stats
+def summary():
+    with lock:
+        items = [(dict(labels)['stage'], histogram) for (name, labels), histogram in histograms.items()
+                 if name == 'stage_seconds']
+        return {stage: dict({f"p{int(q * 100)}": round(value, 4) for q, value in histogram.quantiles().items()},
+                            count=histogram.count, total=round(histogram.sum, 3))
+                for stage, histogram in sorted(items)}
+
+
+# Everything recorded in this process since the last drain, to be merged into the web process
+def drain():
+    global histograms, counters
+    with lock:
+        drained = {'histograms': [(name, labels, histogram.buckets, histogram.sum, histogram.count,
+                                   list(histogram.recent)) for (name, labels), histogram in histograms.items()],
+                   'counters': list(counters.items())}
+        histograms, counters = {}, {}
+    return drained
+
+
+def merge(drained):
+    with lock:
+        for name, labels, buckets, total, observations, recent in drained['histograms']:
+            histogram = histograms.get((name, tuple(labels)))
+            if histogram is None:
+                histogram = histograms[(name, tuple(labels))] = Histogram()
+            histogram.buckets = [a + b for a, b in zip(histogram.buckets, buckets)]
+            histogram.sum += total
+            histogram.count += observations
+            histogram.recent.extend(recent)
+        for key, amount in drained['counters']:
+            name, labels = key
+            counters[(name, tuple(labels))] = counters.get((name, tuple(labels)), 0) + amount
+
+
+# Done callback for jobs submitted to the worker pool
+def merge_job_future(future):
+    try:
+        drained = future.result()
+    except Exception:
+        return  # The worker process died; jobs.py recovers the job
+    if drained:
+        merge(drained)
+
+
+# ---------- REQUESTS ------------ #
+def valid_request_id(request_id):
+    return isinstance(request_id, str) and REQUEST_ID_PATTERN.fullmatch(request_id) is not None
+
+
+# Registered with before_app_request / after_app_request: every request gets an id (the client's
+# X-Request-ID if it sent a valid one), which is returned in the response header and used in the request log
+def start_request():
+    request_id = request.headers.get(REQUEST_ID_HEADER)
+    g.request_id = request_id if valid_request_id(request_id) else uuid.uuid4().hex
+    g.request_start = time.perf_counter()
+    g.spans = []
+
+
+def finish_request(response):
+    start = getattr(g, 'request_start', None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or "unmatched"
+    observe('request_seconds', elapsed, endpoint=endpoint)
+    count('requests_total', endpoint=endpoint, status=response.status_code)
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+
+    if LOG_REQUESTS:
+        print(json.dumps({'request_id': g.request_id, 'method': request.method, 'path': request.path,
+                          'endpoint': endpoint, 'status': response.status_code, 'seconds': round(elapsed, 4),
+                          'spans': g.spans}))
+    return response
+
+
+def current_request_id():
+    return getattr(g, 'request_id', None) if has_request_context() else None
+
+
+# ---------- EXPOSITION ------------ #
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _family(lines, name, kind, help_text=None):
+    if help_text:
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+    lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+
+
+# Prometheus text format of the recorded histograms and counters, plus values read at scrape time
+# (queue depths, cache stats) given as {name: (type, help, [(labels, value)])}
+def exposition(current=None):
+    lines = []
+    with lock:
+        for name in sorted({name for name, _ in histograms}):
+            series = sorted((labels, histogram) for (n, labels), histogram in histograms.items() if n == name)
+            _family(lines, name, "histogram", HELP.get(name))
+            for labels, histogram in series:
+                cumulative = 0
+                for bound, bucket in zip(list(BUCKETS) + ["+Inf"], histogram.buckets):
+                    cumulative += bucket
+                    lines.append(f"{PREFIX}_{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{PREFIX}_{name}_sum{_labels(labels)} {_number(histogram.sum)}")
+                lines.append(f"{PREFIX}_{name}_count{_labels(labels)} {histogram.count}")
+
+            # Quantiles over the recent window as a separate gauge, the histogram stays aggregatable
+            _family(lines, f"{name}_quantile", "gauge", f"{HELP.get(name, name)}, over the last {WINDOW} observations")
+            for labels, histogram in series:
+                for q, value in histogram.quantiles().items():
+                    lines.append(f"{PREFIX}_{name}_quantile{_labels(labels, [('quantile', q)])} {_number(value)}")
+
+        for name in sorted({name for name, _ in counters}):
+            _family(lines, name, "counter", HELP.get(name))
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{PREFIX}_{name}{_labels(labels)} {_number(value)}")
+
+    for name, (kind, help_text, series) in sorted((current or {}).items()):
+        _family(lines, name, kind, help_text)
+        for labels, value in series:
+            lines.append(f"{PREFIX}_{name}{_labels(sorted(labels.items()))} {_number(value)}")
+    return "\n".join(lines) + "\n"
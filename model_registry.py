@@ -0,0 +1,96 @@
+import threading
+import time
+
+import torch
+
+# Check if CUDA (GPU) is available, otherwise use CPU
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+GENRE_MODEL_NAME = "gastonduault/music-classifier"
+FEATURE_EXTRACTOR_NAME = "facebook/wav2vec2-large"
+DEMUCS_MODEL_NAME = "htdemucs"
+# Device for source separation, e.g. torch.device("cpu") to keep the GPU for the classifier
+DEMUCS_DEVICE = None
+
+# Models are loaded on first use and kept for the lifetime of the process
+loaders = {}
+models = {}
+load_times = {}  # name -> seconds spent loading
+locks = {}
+registry_lock = threading.Lock()
+
+
+def register(name, loader):
+    with registry_lock:
+        loaders[name] = loader
+        locks.setdefault(name, threading.Lock())
+
+
+def is_loaded(name):
+    return name in models
+
+
+def get(name):
+    if name in models:
+        return models[name]
+    if name not in loaders:
+        raise KeyError(f"No model registered as '{name}'")
+
+    # One lock per model so loading Demucs doesn't block a request waiting for the classifier
+    with locks[name]:
+        if name not in models:
+            start = time.perf_counter()
+            models[name] = loaders[name]()
+            load_times[name] = round(time.perf_counter() - start, 3)
+            print(f"Loaded {name} on {device} in {load_times[name]:.2f}s")
+    return models[name]
+
+
+# Load the given models (all registered ones by default) ahead of the first request
+def warm_up(names=None):
+    for name in names or list(loaders):
+        get(name)
+    return dict(load_times)
+
+
+def _load_genre_model():
+    from transformers import Wav2Vec2ForSequenceClassification
+    model = Wav2Vec2ForSequenceClassification.from_pretrained(GENRE_MODEL_NAME)
+    model.to(device)
+    model.eval()
+    return model
+
+
+def _load_feature_extractor():
+    from transformers import Wav2Vec2FeatureExtractor
+    return Wav2Vec2FeatureExtractor.from_pretrained(FEATURE_EXTRACTOR_NAME)
+
+
+def _demucs_loader(model_name):
+    def load():
+        from demucs.pretrained import get_model
+        model = get_model(name=model_name)
+        model.to(DEMUCS_DEVICE or device)
+        model.eval()
+        return model
+    return load
+
+
+register("genre_model", _load_genre_model)
+register("feature_extractor", _load_feature_extractor)
+register(f"demucs:{DEMUCS_MODEL_NAME}", _demucs_loader(DEMUCS_MODEL_NAME))
+
+
+def get_genre_model():
+    return get("genre_model")
+
+
+def get_feature_extractor():
+    return get("feature_extractor")
+
+
+def get_demucs_model(model_name=DEMUCS_MODEL_NAME):
+    name = f"demucs:{model_name}"
+    if name not in loaders:
+        register(name, _demucs_loader(model_name))
+    return get(name)
@@ -0,0 +1,211 @@
+import cProfile
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+import metrics
+
+# Opt-in profiling of the heavy endpoints, to find out where the slow tail of requests goes without running
+# everything under a profiler. While enabled, every request to PROFILED_ENDPOINTS has its stack sampled
+# every SAMPLE_INTERVAL seconds (cheap), and the samples are kept if it took longer than SLOW_SECONDS.
+# A SAMPLE_FRACTION of the requests is also run under cProfile, with a torch profiler trace of every
+# model call. Renders, separations and preset re-renders queued by a profiled request are profiled on
+# the job worker the same way (model calls batched by the inference server run on its own thread and are not traced).
+# Everything is stored under PROFILE_FOLDER/<request id>/:
+#
+#   profile.json               endpoint, status, duration and why it was kept
+#   request.folded             sampled stacks in the folded format of flamegraph.pl / speedscope
+#   request.prof               cProfile stats (python -m pstats request.prof), sampled requests only
+#   request.torch.genre.0.json torch profiler trace (chrome://tracing), sampled requests only
+#   job_render.*               the same for the job the request queued
+ENABLED = False
+PROFILED_ENDPOINTS = {'user_actions.upload_wav', 'user_actions.complete_upload', 'user_actions.generate_audio',
+                      'user_actions.generate_audio_batch', 'user_actions.preview_audio', 'user_actions.split',
+                      'admin_actions.save_eq_presets'}
+SLOW_SECONDS = 5.0
+SLOW_JOB_SECONDS = 60.0  # Renders and separations are expected to take longer than a request
+SAMPLE_FRACTION = 0.01
+SAMPLE_INTERVAL = 0.005
+MAX_TORCH_TRACES = 8  # Per profile, e.g. a long separation calls the model once per segment
+PROFILE_FOLDER = os.path.join("cache", "profiles")
+MAX_PROFILES = 200  # The oldest profile folders are removed beyond this
+
+local = threading.local()  # The profile of the request or job running on this thread
+
+
+# Samples the stack of one thread from a background thread
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True, name="stack-sampler")
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+
+class Profile:
+    def __init__(self, request_id, name, sampled, slow_seconds):
+        # The id names a folder under PROFILE_FOLDER, so anything but a plain token gets a fresh one
+        if not metrics.valid_request_id(request_id):
+            request_id = uuid.uuid4().hex
+        self.request_id = request_id
+        self.name = name  # "request" or "job_<kind>", the prefix of the files
+        self.sampled = sampled
+        self.slow_seconds = slow_seconds
+        self.folder = os.path.join(PROFILE_FOLDER, request_id)
+        self.torch_traces = 0
+        self.sampler = None
+        self.cprofile = None
+        self.start = None
+
+    def begin(self):
+        self.start = time.perf_counter()
+        self.sampler = StackSampler(threading.get_ident())
+        self.sampler.start()
+        if self.sampled:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        local.profile = self
+
+    # Stops profiling and stores the result if the run was slow or sampled, returns why it was kept (or None)
+    def end(self, **info):
+        local.profile = None
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        stacks = self.sampler.stop()
+        elapsed = time.perf_counter() - self.start
+
+        reason = "sampled" if self.sampled else "slow" if elapsed >= self.slow_seconds else None
+        if reason is None:
+            return None
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, f"{self.name}.folded"), "w") as f:
+            f.writelines(f"{stack} {samples}\n" for stack, samples in stacks.most_common())
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(os.path.join(self.folder, f"{self.name}.prof"))
+        _update_info(self.folder, self.name, dict(info, reason=reason, seconds=round(elapsed, 4),
+                                                  samples=sum(stacks.values()), torch_traces=self.torch_traces))
+        prune()
+        return reason
+
+    def trace_path(self, model_name):
+        path = os.path.join(self.folder, f"{self.name}.torch.{model_name}.{self.torch_traces}.json")
+        self.torch_traces += 1
+        return path
+
+
+# profile.json lists the request and the jobs it queued, each under its own name
+def _update_info(folder, name, info):
+    path = os.path.join(folder, "profile.json")
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        profile = {}
+    profile[name] = dict(info, recorded_at=time.time())
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+
+
+def prune(max_profiles=MAX_PROFILES, folder=PROFILE_FOLDER):
+    try:
+        entries = [os.path.join(folder, name) for name in os.listdir(folder)]
+    except FileNotFoundError:
+        return
+    if len(entries) <= max_profiles:
+        return
+    for path in sorted(entries, key=os.path.getmtime)[:len(entries) - max_profiles]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+# Torch profiler trace of a model call, when the request or job on this thread is a sampled one
+@contextmanager
+def model_call(model_name):
+    profile = getattr(local, 'profile', None)
+    if profile is None or not profile.sampled or profile.torch_traces >= MAX_TORCH_TRACES:
+        yield
+        return
+
+    import torch
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities) as trace:
+        yield
+    os.makedirs(profile.folder, exist_ok=True)
+    trace.export_chrome_trace(profile.trace_path(model_name))
+
+
+# ---------- REQUESTS ------------ #
+# Registered as before_request / after_request / teardown_request of the blueprints serving the endpoints
+def start_request():
+    if not ENABLED or request.endpoint not in PROFILED_ENDPOINTS:
+        return
+    request_id = metrics.current_request_id() or uuid.uuid4().hex
+    g.profile = Profile(request_id, "request", random.random() < SAMPLE_FRACTION, SLOW_SECONDS)
+    g.profile.begin()
+
+
+def finish_request(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.end(endpoint=request.endpoint, path=request.path, method=request.method,
+                    status=response.status_code)
+    return response
+
+
+# The view raised and after_request didn't run
+def teardown_request(exception=None):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.end(endpoint=request.endpoint, path=request.path, method=request.method, status=500,
+                    error=repr(exception))
+
+
+# Profiling options to queue with a job, so the job worker profiles a job started by a profiled request
+def job_options():
+    if not has_request_context():
+        return None
+    profile = g.get('profile')
+    if profile is None:
+        return None
+    return {'request_id': profile.request_id, 'sampled': profile.sampled, 'slow_seconds': SLOW_JOB_SECONDS}
+
+
+# Runs in a job worker around the job handler
+@contextmanager
+def job_profile(options, kind, job_id):
+    if not options:
+        yield
+        return
+    profile = Profile(options['request_id'], f"job_{kind}", options['sampled'], options['slow_seconds'])
+    profile.begin()
+    try:
+        yield
+    finally:
+        profile.end(job_id=job_id, kind=kind)
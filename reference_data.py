@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import db_connection
+
+# The genres and eq_levels tables are small and only change when an admin saves a preset,
+# so they are loaded once per process and served from memory. Saving a preset touches
+# VERSION_FILE, which makes every worker process reload on its next lookup.
+VERSION_FILE = os.path.join("cache", "reference_data.version")
+
+EQ_COLUMNS = ['sub_bass', 'bass', 'lower_midrange', 'midrange', 'upper_midrange',
+              'low_treble', 'treble', 'presence', 'brilliance', 'air']
+
+data = None  # {'genres': [...], 'eq_levels': {genre_id: [...]}, 'version': ...}
+data_lock = threading.Lock()
+
+
+def current_version():
+    try:
+        return os.stat(VERSION_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def _load(version):
+    connection = db_connection.get_db_conn()
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT * FROM genres")
+        genres = cursor.fetchall()
+        cursor.execute(f"SELECT genre_id, {', '.join(EQ_COLUMNS)} FROM eq_levels")
+        eq_levels = {row['genre_id']: [row[column] for column in EQ_COLUMNS] for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+    return {'genres': genres, 'eq_levels': eq_levels, 'version': version}
+
+
+def _get():
+    global data
+    version = current_version()
+    current = data  # invalidate() may reset the global at any time, only use this snapshot
+    if current is not None and current['version'] == version:
+        return current
+    with data_lock:
+        current = data
+        if current is None or current['version'] != version:
+            current = data = _load(version)
+    return current
+
+
+def get_genres():
+    return _get()['genres']
+
+
+# {genre_id - 1: genre}, the class index -> name mapping used by find_genre
+def get_genre_mapping():
+    return {item['genre_id'] - 1: item['genre'] for item in get_genres()}
+
+
+# The ten band levels of a genre's preset, or None for an unknown genre
+def get_eq_levels(genre_id):
+    return _get()['eq_levels'].get(genre_id)
+
+
+# Short fingerprint of a genre's current preset values; renders made with a different version are stale
+def get_preset_version(genre_id):
+    levels = get_eq_levels(genre_id)
+    if levels is None:
+        return None
+    return hashlib.sha1(json.dumps([float(level) for level in levels]).encode()).hexdigest()[:12]
+
+
+# Call after committing a change to genres or eq_levels
+def invalidate():
+    global data
+    os.makedirs(os.path.dirname(VERSION_FILE), exist_ok=True)
+    with open(VERSION_FILE, "w") as f:
+        f.write(str(time.time()))
+    with data_lock:
+        data = None
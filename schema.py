@@ -0,0 +1,61 @@
+import threading
+
+import db_connection
+
+# Tables added on top of the original db_genreator schema, created on first use
+TABLES = [
+    '''CREATE TABLE IF NOT EXISTS audio_hashes (
+        content_hash CHAR(64) NOT NULL PRIMARY KEY,
+        stored_file VARCHAR(255) NOT NULL,
+        genre_id INT,
+        size_bytes BIGINT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''',
+    '''CREATE TABLE IF NOT EXISTS hash_renders (
+        content_hash CHAR(64) NOT NULL,
+        genre_id INT NOT NULL,
+        preset_version VARCHAR(40) NOT NULL,
+        rendered_file VARCHAR(255) NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (content_hash, genre_id, preset_version),
+        KEY hash_renders_file (rendered_file))''',
+]
+
+# Columns added to existing tables: (table, column, definition)
+COLUMNS = [
+    ('renderings', 'rendered_size', 'BIGINT NULL'),  # Bytes, stored when the render is assigned
+    ('renderings', 'rendered_duration', 'DOUBLE NULL'),  # Seconds
+    ('renderings', 'rendered_variants', 'VARCHAR(64) NULL'),  # Formats on disk, e.g. "flac,opus"
+    ('renderings', 'render_genre_id', 'INT NULL'),  # Preset the render was made with (NULL: genre_id)
+    ('renderings', 'preset_version', 'VARCHAR(40) NULL'),  # reference_data.get_preset_version at render time
+]
+
+schema_ready = False
+schema_lock = threading.Lock()
+
+
+def _column_exists(cursor, table, column):
+    cursor.execute('''SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s''', (table, column))
+    return cursor.fetchone()[0] > 0
+
+
+# Create missing tables and columns, once per process
+def ensure_schema():
+    global schema_ready
+    if schema_ready:
+        return
+    with schema_lock:
+        if schema_ready:
+            return
+        connection = db_connection.get_db_conn()
+        cursor = connection.cursor()
+        try:
+            for statement in TABLES:
+                cursor.execute(statement)
+            for table, column, definition in COLUMNS:
+                if not _column_exists(cursor, table, column):
+                    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            connection.commit()
+        finally:
+            cursor.close()
+        schema_ready = True
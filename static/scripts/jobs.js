@@ -0,0 +1,20 @@
+// Poll a job's status url until it is done, rejects if the job failed
+function waitForJob(statusUrl, interval = 1000) {
+    return new Promise((resolve, reject) => {
+        const poll = () => {
+            fetch(statusUrl)
+                .then(response => response.json())
+                .then(job => {
+                    if (job['status'] === 'done') {
+                        resolve(job);
+                    } else if (job['status'] === 'failed' || job['error']) {
+                        reject(new Error(job['error']));
+                    } else {
+                        setTimeout(poll, interval);
+                    }
+                })
+                .catch(reject);
+        };
+        poll();
+    });
+}
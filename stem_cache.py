@@ -0,0 +1,101 @@
+import json
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import metrics
+from audio_formats import STORAGE_FORMAT
+
+# Separated stems are stored per (audio content, model, params) so any stem of an
+# already separated file can be served from disk without running Demucs again
+CACHE_FOLDER = "splitter_cache"
+MAX_CACHE_BYTES = 4 * 1024 ** 3  # 4 GB
+
+stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+stats_lock = threading.Lock()
+
+
+def cache_key(audio_hash, model_name, params):
+    payload = json.dumps({'audio': audio_hash, 'model': model_name, 'params': params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def entry_dir(key):
+    return os.path.join(CACHE_FOLDER, key)
+
+
+def stem_path(key, source_name):
+    return os.path.join(entry_dir(key), f"{source_name}.{STORAGE_FORMAT}")
+
+
+# Also counted in metrics, so lookups made on the job workers reach /metrics
+def _count(name):
+    with stats_lock:
+        stats[name] += 1
+    metrics.count(f'cache_{name}_total', cache="stems")
+
+
+# Returns the cached stem path or None, and counts the hit/miss
+def lookup(key, source_name):
+    path = stem_path(key, source_name)
+    if os.path.exists(path):
+        _count('hits')
+        now = time.time()
+        try:
+            os.utime(entry_dir(key), (now, now))  # Mark as recently used for LRU eviction
+        except OSError:
+            pass
+        return path
+    _count('misses')
+    return None
+
+
+# Write every stem of one separation into the cache, write_entry(directory) writes <source>.<STORAGE_FORMAT>
+# files (FLAC), see stem_path
+def store(key, write_entry):
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    final_dir = entry_dir(key)
+    temp_dir = os.path.join(CACHE_FOLDER, f".tmp_{uuid.uuid4().hex}")
+    os.makedirs(temp_dir)
+    try:
+        write_entry(temp_dir)
+        # Publish atomically so concurrent readers never see a half written entry
+        os.rename(temp_dir, final_dir)
+    except Exception:
+        # Failed separation, or another request stored the same entry first
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        if not os.path.isdir(final_dir):
+            raise
+    evict()
+    return final_dir
+
+
+def entry_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+# Remove least recently used entries until the cache fits in max_bytes
+def evict(max_bytes=MAX_CACHE_BYTES):
+    if not os.path.isdir(CACHE_FOLDER):
+        return
+    entries = [entry for entry in os.scandir(CACHE_FOLDER) if entry.is_dir() and not entry.name.startswith(".")]
+    sizes = {entry.path: entry_size(entry.path) for entry in entries}
+    total = sum(sizes.values())
+
+    for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total -= sizes[entry.path]
+        _count('evictions')
+
+
+def cache_stats():
+    with stats_lock:
+        result = dict(stats)
+    lookups = result['hits'] + result['misses']
+    result['hit_rate'] = round(result['hits'] / lookups, 3) if lookups else 0.0
+    return result
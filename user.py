@@ -1,17 +1,45 @@
 import os
+import uuid
 from werkzeug.utils import secure_filename
-from flask import Blueprint, render_template, session, redirect, url_for, request, jsonify
+from flask import Blueprint, render_template, session, redirect, url_for, request, jsonify, send_file
+import admission
+import audio_assets
+import audio_delivery
+import audio_formats
+import chunked_upload
+import content_index
 import db_connection
-from demucs_splitter import separate_vocals, separate_drums, separate_bass, separate_other
-from ensemble import ensemble_eq
-from genre_identify import find_genre
+import jobs
+import metrics
+import profiling
+import reference_data
+import schema
+from ensemble import FREQ_BANDS, PREVIEW_SECONDS, preset_gains, render_excerpt
+from genre_identify import find_genre, start_inference_server
+from hashing import cached_file_sha256, save_stream
 
 user_blueprint = Blueprint('user_actions', __name__)
-connection = db_connection.get_db_conn()
+user_blueprint.teardown_app_request(db_connection.close_db_conn)  # Return the pooled connection
+# Opt-in profiling of slow or sampled upload/render/preview/split requests, see profiling.py
+user_blueprint.before_request(profiling.start_request)
+user_blueprint.after_request(profiling.finish_request)
+user_blueprint.teardown_request(profiling.teardown_request)
+
+# Genre classification requests from all request threads are micro-batched on one model thread
+start_inference_server()
+# Resume unfinished jobs once the app is set up
+user_blueprint.record_once(lambda state: jobs.start())
 
 UPLOAD_FOLDER = "static/audios/original"
 RENDERED_FOLDER = "static/audios/rendered/"
+SPLITTER_INPUT_FOLDER = "static/audios/splitter_input"
+SPLITTER_OUTPUT_FOLDER = "static/audios/splitter_output"
 ALLOWED_EXTENSIONS = {"wav"}
+# Splitter dropdown value -> Demucs source name
+SPLIT_SOURCES = {"Vocals": "vocals", "Drums": "drums", "Bass": "bass", "Others": "other"}
+# Which audio_delivery folder the output of each job kind is served from
+JOB_OUTPUT_KINDS = {"render": "rendered", "render_batch": "rendered", "split": "stems"}
+MAX_BATCH_PRESETS = 10
 # Ensure the folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
@@ -23,7 +51,7 @@ def allowed_file(filename):
 @user_blueprint.route('/home')
 def index():
     if session.get('logged_in'):
-        connection.reconnect()
+        connection = db_connection.get_db_conn()
         cursor = connection.cursor(dictionary=True)
         cursor.execute('''SELECT * FROM renderings WHERE u_id = %s AND status = 1''', (session['u_id'],))
         songs = cursor.fetchall()
@@ -51,31 +79,51 @@ def split():
     if file.filename == "":
         return jsonify({"error": "No selected file"}), 400
 
-    # Save the file temporarily
-    filename = secure_filename(file.filename)
+    source_name = SPLIT_SOURCES.get(audio_type)
+    if not source_name:
+        return jsonify({"error": "Invalid audio type"}), 400
+
+    # Save the file temporarily. Every job gets its own input and stem names, so two users splitting a
+    # "song.wav" at the same time don't overwrite each other's files before their jobs run.
+    filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
     filename_wo_ext = os.path.splitext(os.path.basename(filename))[0]
-    temp_filepath = os.path.join('E:\Main Project\FlaskEq\static\\audios\splitter_input', filename)
-    output_path = 'E:\Main Project\FlaskEq\static\\audios\splitter_output'
+    os.makedirs(SPLITTER_INPUT_FOLDER, exist_ok=True)
+    temp_filepath = os.path.join(SPLITTER_INPUT_FOLDER, filename)
     file.save(temp_filepath)
-    extracted_file = ''
-    if audio_type == "Vocals":
-        separate_vocals(temp_filepath, output_path)
-        extracted_file = (filename_wo_ext + '_vocals.wav')
-    elif audio_type == "Drums":
-        separate_drums(temp_filepath, output_path)
-        extracted_file = (filename_wo_ext + '_drums.wav')
-    elif audio_type == "Bass":
-        separate_bass(temp_filepath, output_path)
-        extracted_file = (filename_wo_ext + '_bass.wav')
-    elif audio_type == "Others":
-        separate_other(temp_filepath, output_path)
-        extracted_file = (filename_wo_ext + '_other.wav')
-
-    file_size_bytes = os.path.getsize(output_path + '\\' + extracted_file)
-    file_size_mb = round(file_size_bytes / (1024 * 1024), 2)
-    return jsonify(
-        {"message": "Audio generated successfully", 'audio_type': audio_type, 'file_size_mb': f'{file_size_mb:.2f} MB',
-         'extracted_url': url_for('static', filename=f'audios/splitter_output/{extracted_file}')}), 200
+
+    # Separation runs on the job workers, the client polls the status url
+    try:
+        job_id = jobs.enqueue('split', {'input_path': temp_filepath, 'output_dir': SPLITTER_OUTPUT_FOLDER,
+                                        'source_name': source_name, 'audio_type': audio_type,
+                                        'output_name': f'{filename_wo_ext}_{source_name}.{audio_formats.STORAGE_FORMAT}'},
+                              user_id=session.get('u_id'))
+    except jobs.JobQueueFull as e:
+        return admission.rejection_response(e)  # 503 when the queue is full, 429 over the per-user quota
+
+    return jsonify({"message": "Extraction queued", "job_id": job_id,
+                    "status_url": url_for('user_actions.job_status', job_id=job_id)}), 202
+
+
+@user_blueprint.route('/jobs/<job_id>')
+def job_status(job_id):
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    job = jobs.get_job(job_id)
+    if not job or job['user_id'] != session.get('u_id'):
+        return jsonify({'error': 'Job not found'}), 404
+
+    response = {'job_id': job_id, 'kind': job['kind'], 'status': job['status'], 'progress': job['progress']}
+    if job['status'] == jobs.DONE:
+        response.update(job['result'])
+        kind = job['result'].get('audio_kind') or JOB_OUTPUT_KINDS[job['kind']]
+        if 'file' in job['result']:
+            response['output_url'] = url_for('user_actions.audio_file', kind=kind, filename=job['result']['file'])
+        for render in response.get('renders', []):
+            render['url'] = url_for('user_actions.audio_file', kind=kind, filename=render['file'])
+    elif job['status'] == jobs.FAILED:
+        response['error'] = job['error']
+    return jsonify(response), 200
 
 
 @user_blueprint.route('/studio')
@@ -87,20 +135,62 @@ def studio():
 
     song_data = None
     if music_id:
-        connection.reconnect()
+        schema.ensure_schema()
+        connection = db_connection.get_db_conn()
         cursor = connection.cursor(dictionary=True)
-        cursor.execute('''SELECT r.music_id, r.title, r.artist, r.original, r.rendered, r.genre_id, g.genre
+        cursor.execute('''SELECT r.music_id, r.title, r.artist, r.original, r.rendered, r.rendered_size,
+            r.rendered_duration, r.genre_id, g.genre
             FROM renderings r JOIN genres g ON r.genre_id = g.genre_id  WHERE r.music_id = %s ''', (music_id,))
         song_data = cursor.fetchone()  # Get the row
-        file_size_bytes = os.path.getsize(
-            'E:\Main Project\FlaskEq\static\\audios\\rendered' + '\\' + song_data['rendered'])
-        file_size_mb = round(file_size_bytes / (1024 * 1024), 2)
-        song_data['file_size_mb'] = f'{file_size_mb:.2f} MB'
+
+        # Size and duration are stored with the render; rows rendered before that are filled in once here
+        rendered_path = os.path.join(RENDERED_FOLDER, song_data['rendered']) if song_data and song_data['rendered'] else None
+        if rendered_path and song_data['rendered_size'] is None and os.path.exists(rendered_path):
+            song_data['rendered_size'], song_data['rendered_duration'] = audio_delivery.file_metadata(rendered_path)
+            cursor.execute("UPDATE renderings SET rendered_size = %s, rendered_duration = %s WHERE music_id = %s",
+                           (song_data['rendered_size'], song_data['rendered_duration'], music_id))
+            connection.commit()
+        cursor.close()
+
+        if song_data and song_data['rendered_size'] is not None:
+            song_data['file_size_mb'] = audio_delivery.format_size(song_data['rendered_size'])
+        if song_data and song_data['rendered_duration'] is not None:
+            song_data['duration'] = audio_delivery.format_duration(song_data['rendered_duration'])
     return render_template('user/studio.html', username=session['username'],
                            profile_pic=session['profile_pic'], song_data=song_data, current_route=request.endpoint)
 
 
+# Originals, renders and stems, with Range and conditional request support.
+# ?variant=opus|mp3 asks for a lossy streaming copy of a render or stem; the first request for one
+# queues the encode and returns 202 with a status url, later requests are served from disk.
+@user_blueprint.route('/audio/<kind>/<path:filename>')
+def audio_file(kind, filename):
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    variant = request.args.get('variant')
+    if variant and variant != audio_formats.STORAGE_FORMAT:
+        if variant not in audio_formats.PREVIEW_FORMATS or kind not in ('rendered', 'stems'):
+            return jsonify({'error': 'Unknown variant'}), 400
+        source_path = os.path.join(audio_delivery.AUDIO_FOLDERS[kind], secure_filename(filename))
+        if not os.path.exists(source_path):
+            return jsonify({'error': 'File not found'}), 404
+        preview_path = audio_formats.variant_path(source_path, variant)
+        if not os.path.exists(preview_path):
+            try:
+                job_id = jobs.enqueue('preview', {'audio_kind': kind, 'file': os.path.basename(source_path),
+                                                  'format': variant}, user_id=session.get('u_id'))
+            except jobs.JobQueueFull as e:
+                return admission.rejection_response(e)
+            return jsonify({"message": "Preview queued", "job_id": job_id,
+                            "status_url": url_for('user_actions.job_status', job_id=job_id)}), 202
+        filename = os.path.basename(preview_path)
+
+    return audio_delivery.send_audio(kind, filename, download=request.args.get('download') == '1')
+
+
 @user_blueprint.route('/upload_wav', methods=['POST'])
+@admission.limit('upload_wav')
 def upload_wav():
     if not session.get('logged_in'):
         return redirect(url_for('login_out.login_page'))
@@ -123,25 +213,40 @@ def upload_wav():
     if not allowed_file(file.filename):
         return jsonify({"error": "Invalid file format"}), 400
 
-    connection.reconnect()
-    cursor = connection.cursor(dictionary=True)
+    # Save the file temporarily, hashing it while it is written
+    filename = secure_filename(file.filename)
+    temp_filepath = os.path.join(UPLOAD_FOLDER, f".upload_{uuid.uuid4().hex}_{filename}")
+    with metrics.span("upload_save"):
+        content_hash, size_bytes = save_stream(file.stream, temp_filepath)
 
-    # Get genres from database
-    cursor.execute("SELECT * FROM genres")
-    genre_mapping = cursor.fetchall()
+    return register_upload(temp_filepath, filename, content_hash, size_bytes, title, artist)
 
-    # Convert result to a dictionary: {genre_id - 1: genre}
-    genre_dict = {item['genre_id'] - 1: item['genre'] for item in genre_mapping}
 
-    # Save the file temporarily
-    filename = secure_filename(file.filename)
-    temp_filepath = os.path.join(UPLOAD_FOLDER, filename)
-    file.save(temp_filepath)
+# Classify a received upload (unless the same audio was uploaded before), move it into UPLOAD_FOLDER
+# and add it to renderings. temp_filepath is consumed either way.
+def register_upload(temp_filepath, filename, content_hash, size_bytes, title, artist):
+    connection = db_connection.get_db_conn()
+    cursor = connection.cursor(dictionary=True)
 
-    # Identify genre
-    identified_genre = find_genre(temp_filepath, genre_dict)
-    if identified_genre == 'error':
-        return jsonify({"error": identified_genre}), 400
+    # Genres from the reference data cache as a dictionary: {genre_id - 1: genre}
+    genre_dict = reference_data.get_genre_mapping()
+
+    # Same audio uploaded before: reuse the stored file and its detected genre
+    known = content_index.lookup_upload(content_hash)
+    if known and not os.path.exists(os.path.join(UPLOAD_FOLDER, known['stored_file'])):
+        known = None
+    metrics.count('upload_dedup_total', result="hit" if known else "miss")
+
+    if known:
+        os.remove(temp_filepath)  # Not decoded, the stored copy is used
+        identified_genre = {'genre_id': known['genre_id'], 'genre': genre_dict.get(known['genre_id'] - 1, 'error')}
+    else:
+        # Identify genre
+        identified_genre = find_genre(temp_filepath, genre_dict)
+        if identified_genre == 'error':
+            audio_assets.forget(temp_filepath)  # Spilled decode made by find_genre
+            os.remove(temp_filepath)
+            return jsonify({"error": identified_genre}), 400
 
     try:
         # Insert into the database (without file name initially)
@@ -153,33 +258,144 @@ def upload_wav():
 
         inserted_music_id = cursor.lastrowid  # Get the last inserted ID
 
-        # Generate new filename with music_id
-        file_name_w_music_id = f"{inserted_music_id}_{filename}"
-        final_filepath = os.path.join(UPLOAD_FOLDER, file_name_w_music_id)
-
-        # Rename the temporary file
-        os.rename(temp_filepath, final_filepath)
+        rendered_file = None
+        preset_version = reference_data.get_preset_version(identified_genre['genre_id'])
+        if known:
+            file_name_w_music_id = known['stored_file']
+            # A render of this audio with the current preset may already exist
+            rendered_file = content_index.lookup_render(content_hash, identified_genre['genre_id'], preset_version)
+            if rendered_file and not os.path.exists(os.path.join(RENDERED_FOLDER, rendered_file)):
+                rendered_file = None
+        else:
+            # Generate new filename with music_id
+            file_name_w_music_id = f"{inserted_music_id}_{filename}"
+            final_filepath = os.path.join(UPLOAD_FOLDER, file_name_w_music_id)
+
+            # Rename the temporary file, with the decode find_genre made so the render doesn't decode it again
+            audio_assets.rename(temp_filepath, final_filepath)
+            content_index.record_upload(content_hash, file_name_w_music_id, identified_genre['genre_id'], size_bytes)
 
         # Update the database with the correct file name
         cursor.execute("UPDATE renderings SET original = %s WHERE music_id = %s",
                        (file_name_w_music_id, inserted_music_id))
         connection.commit()
+        if rendered_file:
+            content_index.assign_render(inserted_music_id, rendered_file, RENDERED_FOLDER,
+                                        identified_genre['genre_id'], preset_version)
 
         return jsonify({
             "message": "File uploaded successfully",
             "genre": identified_genre['genre'],
             "genre-id": identified_genre['genre_id'],
-            "music-id": inserted_music_id
+            "music-id": inserted_music_id,
+            "duplicate": bool(known),
+            "rendered_file_name": rendered_file
         }), 200
 
     except Exception as e:
         connection.rollback()  # Rollback in case of error
+        if os.path.exists(temp_filepath):
+            audio_assets.forget(temp_filepath)
+            os.remove(temp_filepath)
         return jsonify({"error": f"Database error: {str(e)}"}), 500
 
     finally:
         cursor.close()
 
 
+# ---------- RESUMABLE UPLOADS ------------ #
+# POST /uploads starts an upload, PUT /uploads/<id> with an Upload-Offset header appends a chunk,
+# GET /uploads/<id> tells a reconnecting client where to resume and POST /uploads/<id>/complete
+# classifies and registers the file like upload_wav.
+def upload_error_response(error):
+    body = {"error": str(error)}
+    if error.offset is not None:
+        body['offset'] = error.offset
+    return jsonify(body), error.status
+
+
+def upload_state(meta):
+    return jsonify({"upload_id": meta['upload_id'], "offset": meta['offset'], "size": meta['size'],
+                    "chunk_size": chunked_upload.CHUNK_SIZE, "wav": meta['wav']})
+
+
+@user_blueprint.route('/uploads', methods=['POST'])
+def create_upload():
+    if not session.get('logged_in'):
+        return redirect(url_for('login_out.login_page'))
+
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename') or "")
+    title = data.get('songTitle')
+    artist = data.get('artistName')
+
+    if not filename:
+        return jsonify({"error": "No selected file"}), 400
+    if not title or not artist:
+        return jsonify({"error": "Song title and artist name are required"}), 400
+    if not allowed_file(filename):
+        return jsonify({"error": "Invalid file format"}), 400
+
+    try:
+        meta = chunked_upload.create(session['u_id'], filename, int(data.get('size') or 0),
+                                     {'title': title, 'artist': artist})
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid file size"}), 400
+    except chunked_upload.UploadError as e:
+        return upload_error_response(e)
+    return upload_state(meta), 201
+
+
+@user_blueprint.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login_out.login_page'))
+    try:
+        return upload_state(chunked_upload.load(upload_id, session['u_id']))
+    except chunked_upload.UploadError as e:
+        return upload_error_response(e)
+
+
+@user_blueprint.route('/uploads/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login_out.login_page'))
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({"error": "Upload-Offset header required"}), 400
+    try:
+        # The body is read straight from the socket, never buffered as a whole
+        meta = chunked_upload.append(upload_id, session['u_id'], offset, request.stream, request.content_length)
+    except chunked_upload.UploadError as e:
+        return upload_error_response(e)
+    return upload_state(meta)
+
+
+@user_blueprint.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login_out.login_page'))
+    try:
+        chunked_upload.abort(upload_id, session['u_id'])
+    except chunked_upload.UploadError as e:
+        return upload_error_response(e)
+    return jsonify({"message": "Upload cancelled"}), 200
+
+
+@user_blueprint.route('/uploads/<upload_id>/complete', methods=['POST'])
+@admission.limit('upload_wav')
+def complete_upload(upload_id):
+    if not session.get('logged_in'):
+        return redirect(url_for('login_out.login_page'))
+    try:
+        partial_path, content_hash, meta = chunked_upload.complete(upload_id, session['u_id'])
+    except chunked_upload.UploadError as e:
+        return upload_error_response(e)
+    return register_upload(partial_path, meta['filename'], content_hash, meta['size'],
+                           meta['fields']['title'], meta['fields']['artist'])
+
+
 @user_blueprint.route('/generate_audio', methods=['GET', 'POST'])
 def generate_audio():
     if session.get('logged_in'):
@@ -188,7 +404,7 @@ def generate_audio():
             music_id = data.get('music_id')
             genre_id = data.get('genre_id')
 
-            connection.reconnect()
+            connection = db_connection.get_db_conn()
             cursor = connection.cursor(dictionary=True)
             cursor.execute('''SELECT original FROM renderings WHERE music_id = %s''', (music_id,))
             result_data = cursor.fetchone()
@@ -198,24 +414,40 @@ def generate_audio():
                 return jsonify({"error": "Music ID not found"}), 404
 
             file_name = result_data['original']
-            new_file_name = "EQ_" + file_name
             source_audio_path = os.path.join(UPLOAD_FOLDER, file_name)
+            genre_id = int(genre_id)
+
+            # Renders are shared between uploads of the same audio, so the name identifies the preset used
+            content_hash = content_index.hash_for_file(file_name) or cached_file_sha256(source_audio_path)
+            preset_version = reference_data.get_preset_version(genre_id)
+            if preset_version is None:
+                return jsonify({"error": "Invalid genre ID"}), 400
+            new_file_name = content_index.render_name(file_name, genre_id, preset_version)
+
+            existing = content_index.lookup_render(content_hash, genre_id, preset_version)
+            if existing and os.path.exists(os.path.join(RENDERED_FOLDER, existing)):
+                metrics.count('render_reuse_total', result="hit")
+                content_index.assign_render(music_id, existing, RENDERED_FOLDER, genre_id, preset_version)
+                return jsonify({"message": "Audio generated successfully", "rendered_file_name": existing}), 200
+            metrics.count('render_reuse_total', result="miss")
 
             # ---------- RENDERING AUDIO ------------ #
-            result = ensemble_eq(source_audio_path, int(genre_id), os.path.join(RENDERED_FOLDER, new_file_name))
+            # Rendered on the job workers, which also store the file name in renderings when done. A render of
+            # this row to the same file that is already queued or running (e.g. a double-click) is reused.
+            try:
+                job_id = jobs.pending_job('render', music_id=music_id, output_name=new_file_name)
+                if job_id is None:
+                    job_id = jobs.enqueue('render', {'music_id': music_id, 'genre_id': genre_id,
+                                                     'source_path': source_audio_path, 'output_name': new_file_name,
+                                                     'output_path': os.path.join(RENDERED_FOLDER, new_file_name),
+                                                     'content_hash': content_hash, 'preset_version': preset_version},
+                                          user_id=session.get('u_id'))
+            except jobs.JobQueueFull as e:
+                return admission.rejection_response(e)  # 503 when the queue is full, 429 over the per-user quota
             # ---------- RENDERING AUDIO ------------ #
 
-            if result:
-                # INSERT INTO DB
-                connection.reconnect()
-                cursor = connection.cursor(dictionary=True)
-                cursor.execute("UPDATE renderings SET rendered = %s WHERE music_id = %s", (new_file_name, music_id))
-                connection.commit()
-                cursor.close()
-                print("Updated Database")
-                return jsonify({"message": "Audio generated successfully", "rendered_file_name": new_file_name}), 200
-            else:
-                return jsonify({"error": "Error generating audio"}), 400
+            return jsonify({"message": "Rendering queued", "job_id": job_id, "rendered_file_name": new_file_name,
+                            "status_url": url_for('user_actions.job_status', job_id=job_id)}), 202
 
         except Exception as e:
             print(f"Exception occurred: {e}")
@@ -224,6 +456,104 @@ def generate_audio():
         return redirect(url_for('login_out.login_page'))
 
 
+# Render one track with several genre presets for A/B comparison. Presets already rendered for this
+# audio are reused, the rest are made by one job that decodes and analyses the track once.
+# Picking one afterwards with generate_audio reuses its render.
+@user_blueprint.route('/generate_audio_batch', methods=['POST'])
+def generate_audio_batch():
+    if not session.get('logged_in'):
+        return redirect(url_for('login_out.login_page'))
+
+    data = request.get_json(silent=True) or {}
+    music_id = data.get('music_id')
+    try:
+        genre_ids = list(dict.fromkeys(int(genre_id) for genre_id in data.get('genre_ids') or []))
+    except (TypeError, ValueError):
+        return jsonify({"error": "genre_ids must be a list of genre IDs"}), 400
+    if not genre_ids or len(genre_ids) > MAX_BATCH_PRESETS:
+        return jsonify({"error": f"Give between 1 and {MAX_BATCH_PRESETS} genre IDs"}), 400
+
+    connection = db_connection.get_db_conn()
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute('''SELECT original FROM renderings WHERE music_id = %s''', (music_id,))
+    result_data = cursor.fetchone()
+    cursor.close()
+    if not result_data:
+        return jsonify({"error": "Music ID not found"}), 404
+
+    file_name = result_data['original']
+    source_audio_path = os.path.join(UPLOAD_FOLDER, file_name)
+    content_hash = content_index.hash_for_file(file_name) or cached_file_sha256(source_audio_path)
+
+    renders, missing = [], []
+    for genre_id in genre_ids:
+        preset_version = reference_data.get_preset_version(genre_id)
+        if preset_version is None:
+            return jsonify({"error": f"Invalid genre ID: {genre_id}"}), 400
+        existing = content_index.lookup_render(content_hash, genre_id, preset_version)
+        if existing and os.path.exists(os.path.join(RENDERED_FOLDER, existing)):
+            renders.append({'genre_id': genre_id, 'file': existing, 'ready': True})
+            continue
+        output_name = content_index.render_name(file_name, genre_id, preset_version)
+        renders.append({'genre_id': genre_id, 'file': output_name, 'ready': False})
+        missing.append({'genre_id': genre_id, 'preset_version': preset_version, 'output_name': output_name,
+                        'output_path': os.path.join(RENDERED_FOLDER, output_name)})
+
+    for render in renders:
+        render['url'] = url_for('user_actions.audio_file', kind='rendered', filename=render['file'])
+    if not missing:
+        return jsonify({"message": "Audio generated successfully", "renders": renders}), 200
+
+    try:
+        job_id = jobs.enqueue('render_batch', {'music_id': music_id, 'source_path': source_audio_path,
+                                               'content_hash': content_hash, 'renders': missing},
+                              user_id=session.get('u_id'))
+    except jobs.JobQueueFull as e:
+        return admission.rejection_response(e)
+    return jsonify({"message": "Rendering queued", "job_id": job_id, "renders": renders,
+                    "status_url": url_for('user_actions.job_status', job_id=job_id)}), 202
+
+
+# Short EQ'd excerpt around a position of the track, with a genre preset (genre_id) or custom band
+# gains (gains, ten values in dB), so a preset can be auditioned before committing to the full render
+@user_blueprint.route('/preview_audio', methods=['POST'])
+@admission.limit('preview_audio')
+def preview_audio():
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.get_json(silent=True) or {}
+    try:
+        start = float(data.get('start') or 0)
+        duration = float(data.get('duration') or PREVIEW_SECONDS)
+        gains = data.get('gains')
+        if gains is not None:
+            gains = [float(gain) for gain in gains]
+            if len(gains) != len(FREQ_BANDS):
+                raise ValueError
+        genre_id = int(data['genre_id']) if gains is None else None
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "Give a genre_id or ten band gains, and a numeric start and duration"}), 400
+
+    connection = db_connection.get_db_conn()
+    cursor = connection.cursor(dictionary=True)
+    cursor.execute("SELECT original FROM renderings WHERE music_id = %s", (data.get('music_id'),))
+    result_data = cursor.fetchone()
+    cursor.close()
+    if not result_data:
+        return jsonify({"error": "Music ID not found"}), 404
+
+    source_audio_path = os.path.join(UPLOAD_FOLDER, result_data['original'])
+    if gains is None:
+        try:
+            gains = preset_gains(source_audio_path, genre_id)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    samples, sr = render_excerpt(source_audio_path, gains, start, duration)
+    return send_file(audio_formats.encode_bytes(samples, sr), mimetype="audio/flac", max_age=0)
+
+
 @user_blueprint.route('/delete_music', methods=['POST'])
 def delete_music():
     if not session.get('logged_in'):
@@ -235,7 +565,7 @@ def delete_music():
     if not music_id:
         return jsonify({'error': 'Missing music_id'}), 400
 
-    connection.reconnect()
+    connection = db_connection.get_db_conn()
     cursor = connection.cursor(dictionary=True)
 
     try:
@@ -250,20 +580,14 @@ def delete_music():
         if not file_names:
             return jsonify({'error': 'Music not found'}), 404
 
-        original_path = os.path.join(UPLOAD_FOLDER, file_names['original']) if file_names['original'] else None
-        rendered_path = os.path.join(RENDERED_FOLDER, file_names['rendered']) if file_names['rendered'] else None
-
         # Delete the database entry first
         cursor.execute('DELETE FROM renderings WHERE music_id = %s', (music_id,))
         connection.commit()  # Temporarily commit DB deletion
 
-        # Try deleting the files if they exist
+        # Try deleting the files, unless another upload of the same audio still uses them
         try:
-            if original_path and os.path.exists(original_path):
-                print(original_path)
-                os.remove(original_path)
-            if rendered_path and os.path.exists(rendered_path):  # Only delete if file exists
-                os.remove(rendered_path)
+            content_index.remove_unreferenced(file_names['original'], file_names['rendered'],
+                                              UPLOAD_FOLDER, RENDERED_FOLDER)
         except Exception as file_error:
             # Rollback the database deletion if file deletion fails
             connection.rollback()
@@ -279,7 +603,7 @@ def delete_music():
 
 @user_blueprint.route('/profile', methods=['GET'])
 def get_profile():
-    connection.reconnect()
+    connection = db_connection.get_db_conn()
     cursor = connection.cursor(dictionary=True)
     cursor.execute('''SELECT * FROM users WHERE u_id = %s''', (session['u_id'],))
     user_data = cursor.fetchone()
@@ -288,7 +612,7 @@ def get_profile():
 
 @user_blueprint.route('/update_profile', methods=['POST'])
 def update_profile():
-    connection.reconnect()
+    connection = db_connection.get_db_conn()
     cursor = connection.cursor(dictionary=True)
 
     u_id = request.form.get("u_id")